@@ -10,6 +10,7 @@ setup(
 		author_email="patrick@patrickomatic.com",
 		requires=['boto', 'PIL', 'django'],
 		url="https://github.com/patrickomatic/django-url-imaging",
-		packages=['urlimaging', 'urlimaging.backends'],
+		packages=['urlimaging', 'urlimaging.backends',
+				'urlimaging.management', 'urlimaging.management.commands'],
 )
 
@@ -6,18 +6,37 @@ Author: Patrick Carroll <patrick@patrickomatic.com>
 Version: 0.1
 
 """
+import os, tempfile
+
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
 from urlimaging.backends.default import *
+from urlimaging.backends.processing import *
 
 VERSION = 0.1
 
-# set up the storage backend - default to S3
+# set up the processing backend - default to processing images in the request thread
+try:
+	getattr(settings, 'IMAGE_PROCESS_POOL_SIZE')
+except AttributeError:
+	# defaults to the number of CPUs
+	settings.IMAGE_PROCESS_POOL_SIZE = None
+
+try:
+	getattr(settings, 'IMAGE_PROCESS_TIMEOUT')
+except AttributeError:
+	settings.IMAGE_PROCESS_TIMEOUT = 30
+
+try:
+	getattr(settings, 'IMAGE_PROCESS_QUEUE_DEPTH')
+except AttributeError:
+	settings.IMAGE_PROCESS_QUEUE_DEPTH = 32
+
 try:
-	settings.IMAGE_STORAGE = eval('%s()' % getattr(settings, 'IMAGE_STORAGE_BACKEND'))
+	settings.IMAGE_PROCESSOR = eval('%s()' % getattr(settings, 'IMAGE_PROCESSOR_BACKEND'))
 except AttributeError:
-	settings.IMAGE_STORAGE = S3ImageStorage()
+	settings.IMAGE_PROCESSOR = InlineImageProcessor()
 
 # default S3_EXPIRES
 try:
@@ -25,6 +44,70 @@ try:
 except AttributeError:
 	settings.S3_EXPIRES = 2 * 24 * 60 * 60
 
+# the fraction of S3_EXPIRES for which a signed url is reused
+try:
+	getattr(settings, 'S3_URL_REUSE_FRACTION')
+except AttributeError:
+	settings.S3_URL_REUSE_FRACTION = 0.5
+
+# whether the bucket is publicly readable, so urls don't need to be signed
+try:
+	getattr(settings, 'S3_PUBLIC_BUCKET')
+except AttributeError:
+	settings.S3_PUBLIC_BUCKET = False
+
+# images bigger than this many bytes are uploaded to S3 in parts of
+# S3_MULTIPART_CHUNK_SIZE bytes, which S3 requires to be at least 5MB
+try:
+	getattr(settings, 'S3_MULTIPART_THRESHOLD')
+except AttributeError:
+	settings.S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+try:
+	getattr(settings, 'S3_MULTIPART_CHUNK_SIZE')
+except AttributeError:
+	settings.S3_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# where SCPImageStorage keeps the socket for its master ssh connection, and
+# how many seconds the connection stays open after it was last used
+try:
+	getattr(settings, 'SSH_CONTROL_PATH')
+except AttributeError:
+	settings.SSH_CONTROL_PATH = os.path.join(tempfile.gettempdir(), 'urlimaging-ssh-%r@%h:%p')
+
+try:
+	getattr(settings, 'SSH_CONTROL_PERSIST')
+except AttributeError:
+	settings.SSH_CONTROL_PERSIST = 600
+
+# the number of images SCPImageStorage deletes at once
+try:
+	getattr(settings, 'SSH_DELETE_BATCH_SIZE')
+except AttributeError:
+	settings.SSH_DELETE_BATCH_SIZE = 100
+
+# the number of levels of subdirectories LocalImageStorage splits images into
+try:
+	getattr(settings, 'IMAGE_STORAGE_SHARD_DEPTH')
+except AttributeError:
+	settings.IMAGE_STORAGE_SHARD_DEPTH = 0
+
+# the backend TieredImageStorage keeps images in, and the directory and number
+# of bytes it keeps local copies of the most recently used ones in
+try:
+	getattr(settings, 'IMAGE_STORAGE_REMOTE_BACKEND')
+except AttributeError:
+	settings.IMAGE_STORAGE_REMOTE_BACKEND = 'S3ImageStorage'
+
+try:
+	getattr(settings, 'IMAGE_LOCAL_CACHE_BYTES')
+except AttributeError:
+	settings.IMAGE_LOCAL_CACHE_BYTES = 1024 * 1024 * 1024
+
+# set up the storage backend (once the settings it uses have their defaults) - default to S3.
+# only a missing IMAGE_STORAGE_BACKEND is defaulted, so that the backend's own errors get through
+settings.IMAGE_STORAGE = eval('%s()' % getattr(settings, 'IMAGE_STORAGE_BACKEND', 'S3ImageStorage'))
+
 # depending on the backend used, make sure that all required settings are supplied
 for setting in settings.IMAGE_STORAGE.get_required_settings():
 	try:
@@ -33,6 +116,76 @@ for setting in settings.IMAGE_STORAGE.get_required_settings():
 		raise ImproperlyConfigured("You must set %s in your settings.py" % setting)
 	
 
+# a directory to keep downloaded originals in, so that images built from the
+# same original don't download it again, and the number of bytes of them to keep
+try:
+	getattr(settings, 'IMAGE_ORIGINAL_CACHE_DIR')
+except AttributeError:
+	settings.IMAGE_ORIGINAL_CACHE_DIR = None
+
+try:
+	getattr(settings, 'IMAGE_ORIGINAL_CACHE_BYTES')
+except AttributeError:
+	settings.IMAGE_ORIGINAL_CACHE_BYTES = 1024 * 1024 * 1024
+
+# seconds to wait when fetching an original to connect, for each read and for
+# the whole fetch
+try:
+	getattr(settings, 'IMAGE_FETCH_CONNECT_TIMEOUT')
+except AttributeError:
+	settings.IMAGE_FETCH_CONNECT_TIMEOUT = 5
+
+try:
+	getattr(settings, 'IMAGE_FETCH_READ_TIMEOUT')
+except AttributeError:
+	settings.IMAGE_FETCH_READ_TIMEOUT = 10
+
+try:
+	getattr(settings, 'IMAGE_FETCH_DEADLINE')
+except AttributeError:
+	settings.IMAGE_FETCH_DEADLINE = 30
+
+# the number of idle connections kept open to each host originals are fetched from
+try:
+	getattr(settings, 'IMAGE_FETCH_POOL_SIZE')
+except AttributeError:
+	settings.IMAGE_FETCH_POOL_SIZE = 4
+
+# the number of originals fetched from a single site at once by each process
+try:
+	getattr(settings, 'IMAGE_FETCH_SITE_CONCURRENCY')
+except AttributeError:
+	settings.IMAGE_FETCH_SITE_CONCURRENCY = 4
+
+# originals bigger than this many bytes or pixels aren't processed
+try:
+	getattr(settings, 'IMAGE_MAX_BYTES')
+except AttributeError:
+	settings.IMAGE_MAX_BYTES = 10 * 1024 * 1024
+
+try:
+	getattr(settings, 'IMAGE_MAX_PIXELS')
+except AttributeError:
+	settings.IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+
+# seconds to remember each kind of failure for, during which requests for the
+# same url fail straight away with a response which can be cached that long
+try:
+	getattr(settings, 'IMAGE_NEGATIVE_CACHE_TTLS')
+except AttributeError:
+	settings.IMAGE_NEGATIVE_CACHE_TTLS = {
+		'not_found': 5 * 60,
+		'unavailable': 30,
+		'not_image': 60 * 60,
+		'unparseable': 60 * 60,
+	}
+
+# named chains of commands which can be used in urls as preset/<name>/
+try:
+	getattr(settings, 'IMAGE_PRESETS')
+except AttributeError:
+	settings.IMAGE_PRESETS = {}
+
 # the function which decides whether or not to process the image
 try:
 	getattr(settings, 'IMAGE_WHITELIST_FN')
@@ -60,3 +213,134 @@ try:
 	getattr(settings, 'USE_TZ')
 except AttributeError:
 	settings.USE_TZ = False
+
+# decode an image once and apply all of its commands in memory rather than
+# re-encoding it after every command
+try:
+	getattr(settings, 'IMAGE_PIPELINE')
+except AttributeError:
+	settings.IMAGE_PIPELINE = True
+
+# seconds after which a worker building an image is assumed to have died
+try:
+	getattr(settings, 'IMAGE_BUILD_LOCK_TIMEOUT')
+except AttributeError:
+	settings.IMAGE_BUILD_LOCK_TIMEOUT = 120
+
+# seconds to wait for another worker that's already building an image
+try:
+	getattr(settings, 'IMAGE_BUILD_WAIT')
+except AttributeError:
+	settings.IMAGE_BUILD_WAIT = 10
+
+# seconds between checks of an original image for changes
+try:
+	getattr(settings, 'IMAGE_CHECK_INTERVAL')
+except AttributeError:
+	settings.IMAGE_CHECK_INTERVAL = 2 * 60 * 60
+
+# bounds on how long an original is left before it's checked again when its
+# server says how long it can be cached for, in seconds.  images are expired by
+# when they were last checked, so the most is kept well below IMAGE_EXPIRATION_DAYS
+try:
+	getattr(settings, 'IMAGE_MIN_CHECK_INTERVAL')
+except AttributeError:
+	settings.IMAGE_MIN_CHECK_INTERVAL = 60
+
+try:
+	getattr(settings, 'IMAGE_MAX_CHECK_INTERVAL')
+except AttributeError:
+	settings.IMAGE_MAX_CHECK_INTERVAL = 24 * 60 * 60
+
+# return images which are due to be checked right away and check them in the background
+try:
+	getattr(settings, 'IMAGE_STALE_WHILE_REVALIDATE')
+except AttributeError:
+	settings.IMAGE_STALE_WHILE_REVALIDATE = False
+
+# seconds after which an image is too stale to return before it's been checked
+try:
+	getattr(settings, 'IMAGE_MAX_STALENESS')
+except AttributeError:
+	settings.IMAGE_MAX_STALENESS = 24 * 60 * 60
+
+# whether images are built while handling a request ('inline') or by the
+# urlimaging_worker command ('queue')
+try:
+	getattr(settings, 'IMAGE_BUILD_MODE')
+except AttributeError:
+	settings.IMAGE_BUILD_MODE = 'inline'
+
+# seconds a request waits for a queued image to be built
+try:
+	getattr(settings, 'IMAGE_QUEUE_WAIT')
+except AttributeError:
+	settings.IMAGE_QUEUE_WAIT = 5
+
+# where to redirect to when a queued image isn't built in time - either
+# 'original' for the original image or the url of a placeholder image
+try:
+	getattr(settings, 'IMAGE_QUEUE_FALLBACK')
+except AttributeError:
+	settings.IMAGE_QUEUE_FALLBACK = 'original'
+
+# times a queued job is tried before it's marked as failed
+try:
+	getattr(settings, 'IMAGE_JOB_ATTEMPTS')
+except AttributeError:
+	settings.IMAGE_JOB_ATTEMPTS = 3
+
+# the number of parsed urls to remember
+try:
+	getattr(settings, 'IMAGE_PARSE_CACHE_SIZE')
+except AttributeError:
+	settings.IMAGE_PARSE_CACHE_SIZE = 10000
+
+# the number of image urls and sites to keep in each process
+try:
+	getattr(settings, 'IMAGE_LOOKUP_CACHE_SIZE')
+except AttributeError:
+	settings.IMAGE_LOOKUP_CACHE_SIZE = 10000
+
+# seconds an image url or site is kept in each process
+try:
+	getattr(settings, 'IMAGE_LOOKUP_LOCAL_TIMEOUT')
+except AttributeError:
+	settings.IMAGE_LOOKUP_LOCAL_TIMEOUT = 60
+
+# the name of one of the project's CACHES to share image urls and sites through
+try:
+	getattr(settings, 'IMAGE_LOOKUP_CACHE')
+except AttributeError:
+	settings.IMAGE_LOOKUP_CACHE = None
+
+# the longest browsers and caches are allowed to cache a redirect to an image
+try:
+	getattr(settings, 'IMAGE_REDIRECT_MAX_AGE')
+except AttributeError:
+	settings.IMAGE_REDIRECT_MAX_AGE = 0
+
+# use permanent redirects to images whose urls don't expire
+try:
+	getattr(settings, 'IMAGE_PERMANENT_REDIRECT')
+except AttributeError:
+	settings.IMAGE_PERMANENT_REDIRECT = False
+
+# how to deliver images, either by redirecting to them ('redirect'), responding
+# with the image itself ('serve') or having the web server send the image
+# ('x-accel-redirect' for nginx or 'x-sendfile' for apache and lighttpd)
+try:
+	getattr(settings, 'IMAGE_DELIVERY')
+except AttributeError:
+	settings.IMAGE_DELIVERY = 'redirect'
+
+# the internal nginx location which maps onto IMAGE_ACCEL_REDIRECT_ROOT
+try:
+	getattr(settings, 'IMAGE_ACCEL_REDIRECT_PREFIX')
+except AttributeError:
+	settings.IMAGE_ACCEL_REDIRECT_PREFIX = '/protected-images/'
+
+try:
+	getattr(settings, 'IMAGE_ACCEL_REDIRECT_ROOT')
+except AttributeError:
+	settings.IMAGE_ACCEL_REDIRECT_ROOT = getattr(settings, 'IMAGE_STORAGE_DIR', getattr(settings, 'MEDIA_ROOT', ''))
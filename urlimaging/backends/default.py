@@ -1,6 +1,9 @@
-import time, shutil, os
+import time, shutil, os, errno, tempfile, socket, httplib, hashlib, subprocess, threading, atexit, pipes, urllib2
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from urlimaging.lru import LRUCache, DiskLRUCache
 
 
 class ImageStorage:
@@ -16,8 +19,29 @@ class ImageStorage:
 	def get_required_settings(self):
 		raise Exception('get_required_settings not implemented')
 
+	def get_url_expiry(self, image):
+		""" The time (as from time.time()) at which the url returned by 
+		    get_image_url stops working, or None if it doesn't """
+		return None
+
+	def open_image(self, image):
+		""" An open file with the contents of an image, for storage which can 
+		    provide one cheaply enough to serve it directly, otherwise None """
+		return None
+
+	def get_image_path(self, image):
+		""" The path of an image on the local filesystem, for storage which keeps
+		    images there, otherwise None """
+		return None
 
-def retry(times, ex):
+	def delete_images(self, images):
+		""" Delete a number of images at once, which backends that can should do
+		    in fewer requests than deleting them one at a time """
+		for image in images:
+			self.delete_image(image)
+
+
+def retry(times, ex, backoff=0, transient=None):
 	""" A decorator which can be called as:
 
 		@retry(5, S3DataError)
@@ -25,63 +49,210 @@ def retry(times, ex):
 			pass
 
 	    and will call fn and if it throws an exception, it will keep
-	    trying 5 times. """
+	    trying 5 times.  With backoff, it waits that many seconds before
+	    trying again, doubling the wait each time, and with transient,
+	    only exceptions for which transient(e) is true are tried again. """
 	def retry_wrap(fn):
 		def fn_wrap(*args, **kwargs):
 			for i in range(times-1):
 				try:
 					return fn(*args, **kwargs)
-				except ex:
-					pass
+				except ex as e:
+					if transient and not transient(e):
+						raise
+				if backoff:
+					time.sleep(backoff * 2 ** i)
 			return fn(*args, **kwargs)
 		return fn_wrap
 	return retry_wrap
 
 
+def transient_error(e):
+	""" Whether an error from S3 is worth trying again: network errors,
+	    5xx responses and S3 asking us to slow down """
+	if isinstance(e, (socket.error, httplib.HTTPException)):
+		return True
+
+	status = getattr(e, 'status', None)
+	if isinstance(status, int) and status >= 500:
+		return True
+
+	return getattr(e, 'error_code', None) in ('RequestTimeout', 'SlowDown')
+
+
+def content_hash(f):
+	""" The sha224 and size of the contents of a file object, read from the
+	    start.  It's left at the start again afterwards. """
+	h, size = hashlib.sha224(), 0
+	f.seek(0)
+	for chunk in iter(lambda: f.read(64 * 1024), b''):
+		h.update(chunk)
+		size += len(chunk)
+	f.seek(0)
+	return h.hexdigest(), size
+
+
+# the number of signed S3 urls to keep around for reuse
+SIGNED_URL_CACHE_SIZE = 10000
+
+
 class S3ImageStorage(ImageStorage):
 	def __init__(self):
 		from boto.s3.connection import S3Connection
 
 		self.connection = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
 		self.bucket = self.connection.get_bucket(settings.S3_BUCKET_NAME)
+		self.signed_urls = LRUCache(SIGNED_URL_CACHE_SIZE)
 
 
 	def delete_image(self, image):
 		from boto.s3.key import Key
 
+		self.signed_urls.delete(image.hashed_filename())
+
 		k = Key(self.bucket, image.hashed_filename())
 		k.delete()
 		k.close()
 
 
-	@retry(3, Exception)
+	def delete_images(self, images):
+		""" Deletes up to 1000 images per request with S3's multi-object delete """
+		names = [image.hashed_filename() for image in images]
+		for name in names:
+			self.signed_urls.delete(name)
+
+		for i in range(0, len(names), 1000):
+			self.delete_keys(names[i:i + 1000])
+
+
+	@retry(3, Exception, 0.5, transient_error)
+	def delete_keys(self, names):
+		result = self.bucket.delete_keys(names, quiet=True)
+		if result.errors:
+			raise Exception('Unable to delete %s' % ', '.join(e.key for e in result.errors))
+
+
 	def save_image(self, image, filename):
+		""" filename is either the path of the image or a file object (such as
+		    a BytesIO) holding it.  Nothing is uploaded if S3 already has an
+		    image with the same contents, and images bigger than 
+		    S3_MULTIPART_THRESHOLD are uploaded in parts so that a failure only
+		    means sending one part again. """
+		f = open(filename, 'rb') if isinstance(filename, basestring) else filename
+		try:
+			digest, size = content_hash(f)
+
+			name = image.hashed_filename()
+			if self.stored_hash(name) == digest:
+				return
+
+			headers = {'Cache-Control': 'public, max-age=%d' % settings.S3_EXPIRES,
+				'Expires': time.asctime(time.gmtime(time.time() + settings.S3_EXPIRES)) }
+			metadata = {'sha224': digest}
+
+			if size > settings.S3_MULTIPART_THRESHOLD:
+				self.upload_multipart(name, f, size, headers, metadata)
+			else:
+				self.upload(name, f, headers, metadata)
+		finally:
+			if f is not filename:
+				f.close()
+
+
+	@retry(3, Exception, 0.5, transient_error)
+	def stored_hash(self, name):
+		""" The hash of the contents of what's stored under name, if anything """
+		key = self.bucket.get_key(name)
+		return key.get_metadata('sha224') if key else None
+
+
+	@retry(3, Exception, 0.5, transient_error)
+	def upload(self, name, f, headers, metadata):
 		from boto.s3.key import Key
 
-		key = Key(self.bucket, image.hashed_filename())
-		key.set_contents_from_filename(filename, 
-				{'Cache-Control': 'public, max-age=%d' % settings.S3_EXPIRES,
-				'Expires': time.asctime(time.gmtime(time.time() + settings.S3_EXPIRES)) })
+		key = Key(self.bucket, name)
+		for k, v in metadata.items():
+			key.set_metadata(k, v)
+		key.set_contents_from_file(f, headers, rewind=True)
 		key.close()
 
 
+	def upload_multipart(self, name, f, size, headers, metadata):
+		upload = self.bucket.initiate_multipart_upload(name, headers=headers, metadata=metadata)
+		try:
+			chunk = settings.S3_MULTIPART_CHUNK_SIZE
+			for part, offset in enumerate(range(0, size, chunk)):
+				self.upload_part(upload, f, part + 1, offset, min(chunk, size - offset))
+			upload.complete_upload()
+		except:
+			upload.cancel_upload()
+			raise
+
+
+	@retry(3, Exception, 0.5, transient_error)
+	def upload_part(self, upload, f, part, offset, size):
+		f.seek(offset)
+		upload.upload_part_from_file(f, part, size=size)
+
+
 	def get_image_url(self, image):
+		""" The url of an image in S3.  Unless S3_PUBLIC_BUCKET is set the url is
+		    signed, and the same signed url is returned until S3_URL_REUSE_FRACTION
+		    of the time it's valid for has passed, so that it can be cached by
+		    browsers. """
 		from boto.s3.key import Key
 
-		key = Key(self.bucket, image.hashed_filename())
+		name = image.hashed_filename()
+		if settings.S3_PUBLIC_BUCKET:
+			return Key(self.bucket, name).generate_url(0, query_auth=False)
+
+		signed = self.signed_urls.get(name)
+		if signed:
+			return signed[0]
+
+		key = Key(self.bucket, name)
 
 		ret = key.generate_url(settings.S3_EXPIRES, 'GET', 
 				{'Cache-Control': 'public, max-age=%d' % settings.S3_EXPIRES,
 				'Expires': time.asctime(time.gmtime(time.time() + settings.S3_EXPIRES)) })
 		key.close()
 
+		# the url is kept along with the time it stops working
+		self.signed_urls.set(name, (ret, time.time() + settings.S3_EXPIRES),
+				settings.S3_EXPIRES * settings.S3_URL_REUSE_FRACTION)
+
 		return ret
 
 
+	def get_url_expiry(self, image):
+		if settings.S3_PUBLIC_BUCKET:
+			return None
+
+		signed = self.signed_urls.get(image.hashed_filename())
+		return signed[1] if signed else time.time()
+
+
 	def get_required_settings(self):
 		return ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'S3_BUCKET_NAME']
 
 
+def shard_path(name, depth, width=2):
+	""" The path of a file named by a hash within a directory split up into
+	    depth levels of subdirectories named by width characters of the hash,
+	    i.e. ab/cd/abcdef....jpg, so that no one directory gets too big """
+	parts = [name[i * width:(i + 1) * width] for i in range(depth)]
+	return os.path.join(*(parts + [name]))
+
+
+def makedirs(path):
+	""" Like os.makedirs(), but doesn't mind if path already exists """
+	try:
+		os.makedirs(path)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+
 class LocalImageStorage(ImageStorage):
 	def get_storage_dir(self):
 		try:
@@ -89,39 +260,136 @@ class LocalImageStorage(ImageStorage):
 		except AttributeError:
 			return settings.MEDIA_ROOT
 
+	def get_relative_path(self, image):
+		return shard_path(image.hashed_filename(), settings.IMAGE_STORAGE_SHARD_DEPTH)
+
+	def get_image_path(self, image):
+		return os.path.join(self.get_storage_dir(), self.get_relative_path(image))
+
 	def delete_image(self, image):
-		os.unlink(os.path.join(self.get_storage_dir(), image.hashed_filename()))
+		os.unlink(self.get_image_path(image))
 
 	def save_image(self, image, filename):
-		shutil.copyfile(filename, os.path.join(self.get_storage_dir(), image.hashed_filename()))
+		""" Images are written under a temporary name in the same directory and
+		    renamed into place, so they're never seen half written.  The work
+		    file is linked rather than copied where it's on the same filesystem. """
+		path = self.get_image_path(image)
+		directory = os.path.dirname(path)
+		makedirs(directory)
+
+		fd, temp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+		os.close(fd)
+		try:
+			try:
+				os.unlink(temp)
+				os.link(filename, temp)
+			except OSError:
+				shutil.copyfile(filename, temp)
+
+			# mkstemp only makes files readable by their owner
+			os.chmod(temp, 0o644)
+			os.rename(temp, path)
+		except:
+			if os.path.exists(temp):
+				os.unlink(temp)
+			raise
+
+	def open_image(self, image):
+		try:
+			return open(self.get_image_path(image), 'rb')
+		except IOError:
+			return None
 
 	def get_image_url(self, image):
 		prefix = settings.IMAGE_PATH_PREFIX if hasattr(settings, 'IMAGE_PATH_PREFIX') else ''
-		return settings.MEDIA_URL + prefix + "/" + image.hashed_filename()
+		return settings.MEDIA_URL + prefix + "/" + self.get_relative_path(image).replace(os.sep, '/')
 
 	def get_required_settings(self):
 		return []
 
 
 class SCPImageStorage(ImageStorage):
-	def identity_file_str(self):
-		try:
-			return "-i " + settings.SSH_IDENTITY_FILE
-		except AttributeError:
-			return ""
+	""" Copies images to another host with scp.  All of the ssh commands share
+	    one master connection (see ControlMaster in ssh_config(5)), which is
+	    kept open for SSH_CONTROL_PERSIST seconds after it's last used so that
+	    each command doesn't pay for a handshake, and deletes of many images 
+	    are sent in batches of SSH_DELETE_BATCH_SIZE. """
+	def __init__(self):
+		self.pending_deletes = []
+		self.lock = threading.Lock()
+		# held while the queued deletes are being sent
+		self.flushing = threading.Lock()
+		atexit.register(self.flush_deletes)
+
+	def ssh_options(self):
+		options = ['-o', 'BatchMode=yes',
+			'-o', 'ControlMaster=auto',
+			'-o', 'ControlPath=%s' % settings.SSH_CONTROL_PATH,
+			'-o', 'ControlPersist=%d' % settings.SSH_CONTROL_PERSIST]
+
+		identity_file = getattr(settings, 'SSH_IDENTITY_FILE', None)
+		if identity_file:
+			options += ['-i', identity_file]
+
+		return options
+
+	def remote_path(self, image):
+		return os.path.join(settings.SSH_MEDIA_PATH, image.hashed_filename())
+
+	def _run(self, args, input=None):
+		""" Run a command without going through a shell, writing input to it if
+		    given, and return its exit status """
+		process = subprocess.Popen(args, stdin=subprocess.PIPE if input is not None else None)
+		process.communicate(input)
+		return process.returncode
+
+	def ssh(self, command, input=None):
+		return self._run(['ssh'] + self.ssh_options() + [settings.SSH_MEDIA_USER, command], input)
 
 	def delete_image(self, image):
-		os.system("ssh %(identify_file)s %(ssh_user)s \"rm %(file_path)s\"" % {
-					'identity_file': self.identity_file_str(),
-					'ssh_user': settings.SSH_MEDIA_USER,
-					'file_path': os.path.join(settings.SSH_MEDIA_PATH, image.hashed_filename())})
+		""" A single image is deleted straight away, along with any queued ones """
+		with self.lock:
+			self.pending_deletes.append(self.remote_path(image))
+		self.flush_deletes()
+
+	def delete_images(self, images):
+		with self.lock:
+			self.pending_deletes += [self.remote_path(image) for image in images]
+			if len(self.pending_deletes) < settings.SSH_DELETE_BATCH_SIZE:
+				return
+		self.flush_deletes()
+
+	def flush_deletes(self):
+		""" Delete all of the queued images with a single ssh command """
+		with self.flushing:
+			with self.lock:
+				paths, self.pending_deletes = self.pending_deletes, []
+
+			if paths:
+				# the remote command is run by a shell, so the paths are quoted
+				self.ssh('rm -f -- ' + ' '.join(pipes.quote(path) for path in paths))
 
 	def save_image(self, image, filename):
-		os.system("scp %(identity_file)s %(filename)s %(ssh_user)s:%(file_path)s" % {
-					'identity_file': self.identity_file_str(),
-					'ssh_user': settings.SSH_MEDIA_USER, 
-					'filename': filename,
-					'file_path': os.path.join(settings.SSH_MEDIA_PATH, image.hashed_filename())})
+		""" filename is either the path of the image or a file object holding
+		    it, which is piped to the remote host.  A queued delete of the same
+		    path is dropped, and one that's already being sent finishes first,
+		    so that it can't remove the new copy. """
+		path = self.remote_path(image)
+		with self.lock:
+			self.pending_deletes = [p for p in self.pending_deletes if p != path]
+		with self.flushing:
+			pass
+
+		if isinstance(filename, basestring):
+			status = self._run(['scp'] + self.ssh_options() + 
+					[filename, '%s:%s' % (settings.SSH_MEDIA_USER, path)])
+		else:
+			filename.seek(0)
+			status = self.ssh('cat > ' + pipes.quote(path), filename.read())
+
+		if status != 0:
+			raise Exception('Unable to copy %s to %s (exit status %d)' % (image.hashed_filename(),
+					settings.SSH_MEDIA_USER, status))
 
 	def get_image_url(self, image):
 		url = settings.PROCESSED_MEDIA_URL
@@ -132,3 +400,85 @@ class SCPImageStorage(ImageStorage):
 
 	def get_required_settings(self):
 		return ['PROCESSED_MEDIA_URL', 'SSH_MEDIA_USER', 'SSH_MEDIA_PATH']
+
+
+# seconds to wait for the remote storage when copying an image to the local tier
+PROMOTE_TIMEOUT = 10
+
+
+class TieredImageStorage(ImageStorage):
+	""" Keeps images in the storage backend named by IMAGE_STORAGE_REMOTE_BACKEND
+	    and the most recently used ones in IMAGE_LOCAL_CACHE_DIR as well, up to
+	    IMAGE_LOCAL_CACHE_BYTES of them.  Images are served from the local copy,
+	    which is made from the remote one if it's missing. """
+	def __init__(self):
+		# the local tier is set up here, before get_required_settings is checked
+		directory = getattr(settings, 'IMAGE_LOCAL_CACHE_DIR', None)
+		if not directory:
+			raise ImproperlyConfigured("You must set IMAGE_LOCAL_CACHE_DIR in your settings.py")
+
+		self.remote = eval('%s()' % settings.IMAGE_STORAGE_REMOTE_BACKEND)
+		self.local = DiskLRUCache(directory, settings.IMAGE_LOCAL_CACHE_BYTES)
+
+	def delete_image(self, image):
+		self.local.delete(image.hashed_filename())
+		self.remote.delete_image(image)
+
+	def delete_images(self, images):
+		for image in images:
+			self.local.delete(image.hashed_filename())
+		self.remote.delete_images(images)
+
+	def save_image(self, image, filename):
+		self.remote.save_image(image, filename)
+
+		f = open(filename, 'rb') if isinstance(filename, basestring) else filename
+		try:
+			f.seek(0)
+			self.local.put(image.hashed_filename(), f)
+		except EnvironmentError:
+			# the local copy is only a cache, it'll be made again when it's read
+			pass
+		finally:
+			if f is not filename:
+				f.close()
+
+	def promote(self, image):
+		""" Copy an image from the remote storage to the local tier, returning
+		    its local path or None if it couldn't be copied """
+		f = self.remote.open_image(image)
+		try:
+			if not f:
+				url = self.remote.get_image_url(image)
+				if not url.startswith('http'):
+					return None
+				f = urllib2.urlopen(url, timeout=PROMOTE_TIMEOUT)
+
+			return self.local.put(image.hashed_filename(), f)
+		except (EnvironmentError, urllib2.URLError, httplib.HTTPException):
+			return None
+		finally:
+			if f:
+				f.close()
+
+	def get_image_path(self, image):
+		return self.local.get(image.hashed_filename()) or self.promote(image)
+
+	def open_image(self, image):
+		path = self.get_image_path(image)
+		if not path:
+			return self.remote.open_image(image)
+
+		try:
+			return open(path, 'rb')
+		except IOError:
+			return self.remote.open_image(image)
+
+	def get_image_url(self, image):
+		return self.remote.get_image_url(image)
+
+	def get_url_expiry(self, image):
+		return self.remote.get_url_expiry(image)
+
+	def get_required_settings(self):
+		return self.remote.get_required_settings() + ['IMAGE_LOCAL_CACHE_DIR']
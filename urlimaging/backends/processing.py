@@ -0,0 +1,75 @@
+import os, threading
+
+from django.conf import settings
+
+from urlimaging.pipeline import run_pipeline, process_data
+
+
+class ImageProcessingException(Exception):
+	pass
+
+
+class ImageProcessor:
+	def process(self, filename, todo):
+		raise Exception('process not implemented')
+
+
+class InlineImageProcessor(ImageProcessor):
+	""" Runs the pipeline in the thread that's handling the request """
+	def process(self, filename, todo):
+		run_pipeline(filename, todo)
+
+
+class ProcessPoolImageProcessor(ImageProcessor):
+	""" Ships the image and its commands off to a pool of worker processes, so
+	    that the transforms aren't serialized on the GIL and a slow one doesn't
+	    hold up the web server's threads any longer than IMAGE_PROCESS_TIMEOUT.
+	    Requires concurrent.futures (the futures package on Python 2). """
+	def __init__(self):
+		self.executor = None
+		self.pid = None
+		self.lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(settings.IMAGE_PROCESS_QUEUE_DEPTH)
+
+
+	def get_executor(self):
+		# the pool is started lazily so that it isn't shared between processes
+		# forked by the web server after settings are loaded
+		with self.lock:
+			if self.pid != os.getpid():
+				from concurrent.futures import ProcessPoolExecutor
+
+				self.executor = ProcessPoolExecutor(settings.IMAGE_PROCESS_POOL_SIZE)
+				self.pid = os.getpid()
+
+			return self.executor
+
+
+	def process(self, filename, todo):
+		from concurrent.futures import TimeoutError
+
+		# don't queue more than IMAGE_PROCESS_QUEUE_DEPTH jobs
+		if not self.slots.acquire(False):
+			raise ImageProcessingException('Too many images waiting to be processed')
+
+		try:
+			with open(filename, 'rb') as f:
+				data = f.read()
+
+			future = self.get_executor().submit(process_data, data, 
+					os.path.splitext(filename)[1], todo)
+		except:
+			self.slots.release()
+			raise
+
+		# the slot is held until the job is done, even if we stop waiting on it
+		future.add_done_callback(lambda f: self.slots.release())
+
+		try:
+			data = future.result(timeout=settings.IMAGE_PROCESS_TIMEOUT)
+		except TimeoutError:
+			future.cancel()
+			raise ImageProcessingException('Timed out processing %s' % filename)
+
+		with open(filename, 'wb') as f:
+			f.write(data)
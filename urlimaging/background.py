@@ -0,0 +1,33 @@
+import sys, threading, traceback
+
+from django.db import connection
+
+
+running = set()
+running_lock = threading.Lock()
+
+
+def run_in_background(key, fn, *args):
+	""" Call fn(*args) in a separate thread so the request doesn't wait for it.
+	    Nothing is started if a call with the same key is still running in
+	    this process. """
+	with running_lock:
+		if key in running:
+			return
+		running.add(key)
+
+	def run():
+		try:
+			fn(*args)
+		except:
+			print >>sys.stderr, "Background task %s failed:" % key
+			traceback.print_exc(file=sys.stderr)
+		finally:
+			with running_lock:
+				running.discard(key)
+			# the thread's database connection isn't closed by request handling
+			connection.close()
+
+	thread = threading.Thread(target=run)
+	thread.daemon = True
+	thread.start()
@@ -0,0 +1,198 @@
+import httplib, socket, threading, time, urllib2, urlparse
+
+from django.conf import settings
+
+
+# the most redirects followed when fetching an original
+MAX_REDIRECTS = 5
+
+# error responses with bodies up to this size are read so that the
+# connection can be used again, bigger ones are just closed
+DRAIN_BYTES = 64 * 1024
+
+
+class FetchLimitExceeded(urllib2.URLError):
+	""" Too many originals are already being fetched from the same site """
+	pass
+
+
+class ConnectionPool:
+	""" Idle keep-alive connections to each host, so that fetching another
+	    original from the same host doesn't mean setting up a new one """
+	def __init__(self, size):
+		self.size = size
+		self.idle = {}
+		self.lock = threading.Lock()
+
+
+	def get(self, scheme, host, port, timeout):
+		""" An idle connection to host, or a new one if there aren't any.
+		    Returns the connection and whether it's been used before. """
+		with self.lock:
+			connections = self.idle.get((scheme, host, port))
+			if connections:
+				return connections.pop(), True
+
+		cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+		return cls(host, port, timeout=timeout), False
+
+	def put(self, scheme, host, port, connection):
+		with self.lock:
+			connections = self.idle.setdefault((scheme, host, port), [])
+			if len(connections) < self.size:
+				connections.append(connection)
+				return
+		connection.close()
+
+	def clear(self):
+		with self.lock:
+			idle, self.idle = self.idle, {}
+
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+
+class SiteLimiter:
+	""" Limits the number of fetches from each site which can happen at once,
+	    so that a slow site can't tie up all of the workers.  Python 2's
+	    semaphores can't time out, so this waits on a condition instead. """
+	def __init__(self, limit):
+		self.limit = limit
+		self.active = {}
+		self.condition = threading.Condition()
+
+
+	def acquire(self, site, deadline):
+		with self.condition:
+			while self.active.get(site, 0) >= self.limit:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise FetchLimitExceeded('Too many fetches from %s' % site)
+				self.condition.wait(remaining)
+
+			self.active[site] = self.active.get(site, 0) + 1
+
+	def release(self, site):
+		with self.condition:
+			self.active[site] -= 1
+			if not self.active[site]:
+				del self.active[site]
+			self.condition.notify_all()
+
+
+class Response:
+	""" A response from Fetcher.fetch(), which looks enough like the one from
+	    urllib2.urlopen() for CommandRunner.get_image().  Closing it gives
+	    the connection back to the pool if the whole body was read. """
+	def __init__(self, fetcher, key, connection, response, site, deadline):
+		self.fetcher = fetcher
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.site = site
+		self.deadline = deadline
+		self.closed = False
+
+
+	def info(self):
+		return self.response.msg
+
+	def read(self, size):
+		if time.time() > self.deadline:
+			raise urllib2.URLError(socket.timeout('Took too long to fetch the original'))
+		return self.response.read(size)
+
+	def close(self):
+		if self.closed:
+			return
+		self.closed = True
+
+		# httplib lets go of the socket once the whole body has been read
+		if self.response.isclosed() and not self.response.will_close:
+			self.fetcher.pool.put(*(self.key + (self.connection,)))
+		else:
+			self.connection.close()
+
+		self.fetcher.limiter.release(self.site)
+
+
+class Fetcher:
+	""" Fetches originals over keep-alive connections, with timeouts for
+	    connecting, for each read and for the whole fetch, and a limit on
+	    how many are fetched from each site at once """
+	def __init__(self):
+		self.pool = ConnectionPool(settings.IMAGE_FETCH_POOL_SIZE)
+		self.limiter = SiteLimiter(settings.IMAGE_FETCH_SITE_CONCURRENCY)
+
+
+	def fetch(self, url, headers=None, site=None):
+		""" Get url, following redirects.  Responses other than a 200 raise an
+		    urllib2.HTTPError and failing to get a response raises an
+		    urllib2.URLError, just like urllib2.urlopen().  site is what the
+		    limit on fetches at once applies to, which defaults to the host. """
+		deadline = time.time() + settings.IMAGE_FETCH_DEADLINE
+		site = site or urlparse.urlsplit(url).netloc.lower()
+
+		self.limiter.acquire(site, deadline)
+		try:
+			for i in range(MAX_REDIRECTS + 1):
+				key, connection, response = self.request(url, headers or {}, deadline)
+
+				location = response.getheader('location')
+				if response.status in (301, 302, 303, 307, 308) and location:
+					self.discard(key, connection, response)
+					url = urlparse.urljoin(url, location)
+					continue
+
+				if response.status != 200:
+					self.discard(key, connection, response)
+					raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+				return Response(self, key, connection, response, site, deadline)
+
+			raise urllib2.URLError('Too many redirects fetching %s' % url)
+		except:
+			self.limiter.release(site)
+			raise
+
+	def request(self, url, headers, deadline):
+		parts = urlparse.urlsplit(url)
+		if parts.scheme not in ('http', 'https'):
+			raise urllib2.URLError('Unable to fetch %s' % url)
+
+		key = (parts.scheme, parts.hostname, parts.port)
+		path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+		headers = dict(headers, **{'User-Agent': 'django-url-imaging'})
+
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				raise urllib2.URLError(socket.timeout('Took too long to fetch %s' % url))
+
+			connection, reused = self.pool.get(*(key + (min(settings.IMAGE_FETCH_CONNECT_TIMEOUT, remaining),)))
+			try:
+				if not connection.sock:
+					connection.connect()
+				connection.sock.settimeout(min(settings.IMAGE_FETCH_READ_TIMEOUT, remaining))
+
+				connection.request('GET', path, headers=headers)
+				return key, connection, connection.getresponse()
+			except (socket.error, httplib.HTTPException) as e:
+				connection.close()
+
+				# the host may have closed a connection that was sitting idle
+				if not reused:
+					raise urllib2.URLError(e)
+
+	def discard(self, key, connection, response):
+		""" Done with a response that isn't wanted, keeping the connection if
+		    it's cheap to read the rest of it """
+		if response.length is not None and response.length <= DRAIN_BYTES and not response.will_close:
+			try:
+				response.read()
+				self.pool.put(*(key + (connection,)))
+				return
+			except (socket.error, httplib.HTTPException):
+				pass
+		connection.close()
@@ -1,4 +1,6 @@
 import re, os
+from io import BytesIO
+from functools import wraps
 from math import atan, degrees
 from PIL import Image, ImageChops, ImageFilter, ImageDraw, ImageFont, ImageFile
 
@@ -7,32 +9,60 @@ from django.conf import settings
 from urlimaging.validator import *
 
 
-TEN_MBS = 10 * 1024 * 1024 * 1024
 RGB_ONLY_FORMATS = set(['.jpg', '.jpeg'])
 
 
 def with_image(fn):
-	""" Decorator that handles the open and closing of an image.  """
+	""" Decorator that handles the open and closing of an image.  The undecorated
+	    function is kept as the transform attribute so that it can also be applied
+	    to an image which has already been decoded (see urlimaging.pipeline). """
+	@wraps(fn)
 	def process(*args):
-		img = fn(Image.open(args[0]), *args[1:])
-
-		ext = os.path.splitext(args[0])[1].lower()
-		if ext in RGB_ONLY_FORMATS and img.mode != 'RGB':
-			img = img.convert('RGB')
-		elif ext == '.png' and img.mode in ('P', 'I', 'RGB'):
-			try:
-				img = img.convert('RGBA').convert('P', palette=Image.ADAPTIVE)
-			except ValueError:
-				# the above conversion can fail for some image modes, so just let it go
-				pass
+		encode_image(fn(Image.open(args[0]), *args[1:]), args[0])
 
+	process.transform = fn
+	return process
+
+
+def image_header(data):
+	""" The format and size of the image that data is the start of, or None
+	    if there isn't enough of it to tell or it isn't an image.  Only the
+	    header is read, so the image isn't decoded. """
+	try:
+		img = Image.open(BytesIO(data))
+	except Exception:
+		# PIL's plugins raise all sorts of things for a truncated header
+		return None
+	return img.format, img.size
+
+
+def encode_image(img, filename, format=None):
+	""" Write img out to filename.  JPEGs are flattened to RGB and PNGs are
+	    quantized to an adaptive palette.  If format isn't given it's taken
+	    from the extension of filename, so it's required when filename is a
+	    file object rather than a path. """
+	if format:
+		ext = '.' + format.lower()
+	else:
+		ext = os.path.splitext(filename)[1].lower()
+
+	if ext in RGB_ONLY_FORMATS and img.mode != 'RGB':
+		img = img.convert('RGB')
+	elif ext == '.png' and img.mode in ('P', 'I', 'RGB'):
 		try:
-			img.save(args[0], quality=95, **img.info)
-		except IOError:
-			ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-			img.save(args[0], quality=95, **img.info)
+			img = img.convert('RGBA').convert('P', palette=Image.ADAPTIVE)
+		except ValueError:
+			# the above conversion can fail for some image modes, so just let it go
+			pass
 
-	return process
+	try:
+		img.save(filename, format, quality=95, **img.info)
+	except IOError:
+		ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+		if hasattr(filename, 'truncate'):
+			filename.seek(0)
+			filename.truncate()
+		img.save(filename, format, quality=95, **img.info)
 
 
 @with_image
@@ -136,21 +166,25 @@ def rotate(img, degrees):
 	return img.rotate(-int(degrees))
 
 
-@with_image
-def thumbnail(img, size):
-	THUMBNAIL_SIZES = { 
-		'small': 64,
-		'medium': 96,
-		'large': 128,
-	}
+THUMBNAIL_SIZES = { 
+	'small': 64,
+	'medium': 96,
+	'large': 128,
+}
 
+def thumbnail_size(size):
+	""" The number of pixels a thumbnail size given in a URL stands for """
 	if size.isdigit():
-		s = int(size)
+		return int(size)
 	elif size in THUMBNAIL_SIZES:
-		s = THUMBNAIL_SIZES[size]
+		return THUMBNAIL_SIZES[size]
 	else:
-		s = THUMBNAIL_SIZES['medium']
+		return THUMBNAIL_SIZES['medium']
 
+
+@with_image
+def thumbnail(img, size):
+	s = thumbnail_size(size)
 	img.thumbnail((s, s), Image.ANTIALIAS)
 	return img
 
@@ -174,17 +208,53 @@ def sharpen(img):
 	return img.filter(ImageFilter.SHARPEN)
 
 
-def convert(filename, format):
-	img = Image.open(filename)
-	if img.mode != 'RGB':
-		img = img.convert('RGB')
+# the primitives below aren't reachable from a URL, they're what the commands
+# are reduced to by urlimaging.planner
+
+@with_image
+def resample(img, width, height):
+	return img.resize((width, height), Image.ANTIALIAS)
+
+
+@with_image
+def crop_box(img, left, upper, right, lower):
+	return img.crop((left, upper, right, lower))
+
+
+@with_image
+def transpose(img, method):
+	return img.transpose(method)
+
 
+def output_format(format):
+	""" The name PIL knows an image format by """
 	# for some reason this chokes on 'JPG'
 	format = format.upper()
 	if format == 'JPG':
 		format = 'JPEG'
 
-	img.save(filename + '.' + format, format, quality=95)
+	return format
+
+
+def converted_extension(format):
+	""" The extension of a file holding an image converted to format """
+	format = format.lower()
+	return '.jpg' if format in ('jpg', 'jpeg') else '.' + format
+
+
+def convert(filename, format):
+	img = Image.open(filename)
+	if img.mode != 'RGB':
+		img = img.convert('RGB')
+
+	img.save(filename, output_format(format), quality=95)
+
+def convert_transform(img, format):
+	if img.mode != 'RGB':
+		img = img.convert('RGB')
+	return img
+
+convert.transform = convert_transform
 
 
 @with_image
@@ -281,6 +351,7 @@ def background(img, color):
 
 
 COMMANDS = [{ 
+		'names': ('resize',),
 		'regex': re.compile(r'^resize/(\d+)x(\d+)/', re.I),
 		'fn': resize, 
 		'title': 'Resize',
@@ -291,6 +362,7 @@ COMMANDS = [{
 			('WIDTHxHEIGHT', 'The width and height of the desired image. Expressed as a width and height specification of the form WIDTHxHEIGHT where WIDTH and HEIGHT are both positive numbers.') 
 		],
 	}, {
+		'names': ('scale',),
 		'regex': re.compile(r'^scale/(\d+)/', re.I),
 		'fn': scale, 
 		'title': 'Scale',
@@ -301,6 +373,7 @@ COMMANDS = [{
 			('PERCENT', 'A value between 0 and 1000 by which to scale the image.  If greater than 100, the image will be increased in size by that percentage amount.') 
 		],
 	}, {
+		'names': ('width',),
 		'regex': re.compile(r'^width/(\d+)/', re.I),
 		'fn': width, 
 		'title': 'Width',
@@ -309,6 +382,7 @@ COMMANDS = [{
 		'format': '<tt>/width/SIZE/IMAGEURL</tt>',
 		'arguments': [ ('SIZE', 'A positive number specifying the target width of the image.') ],
 	}, {
+		'names': ('height',),
 		'regex': re.compile(r'^height/(\d+)/', re.I),
 		'fn': height, 
 		'title': 'Height',
@@ -319,6 +393,7 @@ COMMANDS = [{
 			('SIZE', 'A positive number specifying the target height of the image.') 
 		],
 	}, {
+		'names': ('fit',),
 		'regex': re.compile(r'^fit/(\d+)x(\d+)/', re.I),
 		'fn': fit, 
 		'title': 'Fit',
@@ -329,6 +404,7 @@ COMMANDS = [{
 			('WIDTHxHEIGHT', 'The box that the image must be resized to fit into. Expressed as a width and height specification of the form WIDTHxHEIGHT where WIDTH and HEIGHT are both positive numbers.') 
 		],
 	}, {
+		'names': ('zoom',),
 		'regex': re.compile(r'^zoom/(\d+)x(\d+)/', re.I),
 		'fn': zoom, 
 		'title': 'Zoom',
@@ -339,6 +415,7 @@ COMMANDS = [{
 			('WIDTHxHEIGHT', 'The box that the image must be zoomed to fit into. Expressed as a width and height specification of the form WIDTHxHEIGHT where WIDTH and HEIGHT are both positive numbers.') 
 		],
 	}, {
+		'names': ('thumb', 'thumbnail'),
 		'regex': re.compile(r'^thumb(?:nail)?/(small|medium|large|\d+)/', re.I),
 		'fn': thumbnail, 
 		'title': 'Thumbnail',
@@ -349,6 +426,7 @@ COMMANDS = [{
 			     <tt>/thumb/SIZE/IMAGEURL</tt>""",
 		'arguments': [ ('SIZE', 'A number of pixels or a value of either "small" (64 pixels), "medium" (96 pixels) or "large" (128).') ],
 	}, {
+		'names': ('square',),
 		'regex': re.compile(r'^square/(\d+)/', re.I),
 		'fn': square, 
 		'title': 'Square',
@@ -359,6 +437,7 @@ COMMANDS = [{
 			('SIZE', 'The height and width of the desired square'), 
 		],
 	}, {
+		'names': ('rotate',),
 		'regex': re.compile(r'^rotate/(-?\d+)/', re.I),
 		'fn': rotate, 
 		'title': 'Rotate',
@@ -369,6 +448,7 @@ COMMANDS = [{
 			('DEGREES', 'A value specifying the number of degrees that the image is to be rotated in a clockwise direction.  A negative number will rotate the image in a counter-clockwise direction.') 
 		],
 	}, {
+		'names': ('crop',),
 		'regex': re.compile(r'^crop/(\d+),(\d+),(\d+)x(\d+)/', re.I),
 		'fn': crop, 
 		'title': 'Crop',
@@ -382,6 +462,7 @@ COMMANDS = [{
 			('HEIGHT', 'The height of the rectangle to be cropped.'),
 		],
 	}, {
+		'names': ('watermark', 'wm'),
 		'regex': re.compile(r'^(?:watermark|wm)/([^/]+)/', re.I),
 		'fn': watermark, 
 		'title': 'Watermark',
@@ -393,6 +474,7 @@ COMMANDS = [{
 		],
 		'note': 'It is recommended that after generating the watermarked image, you remove the original image.  Otherwise it will continue to be publicly available.'
 	}, {
+		'names': ('blackwhite', 'bw'),
 		'regex': re.compile(r'^(?:blackwhite|bw)/', re.I),
 		'fn': black_and_white, 
 		'title': 'Black & White',
@@ -401,6 +483,7 @@ COMMANDS = [{
 		'format': '<tt>/bw/IMAGEURL</tt> or <tt>/blackwhite/IMAGEURL</tt>',
 		'arguments': [ ],
 	}, {
+		'names': ('invert',),
 		'regex': re.compile(r'^invert/', re.I),
 		'fn': invert, 
 		'title': 'Invert',
@@ -409,6 +492,7 @@ COMMANDS = [{
 		'format': '<tt>/invert/IMAGEURL</tt>',
 		'arguments': [ ],
 	}, {
+		'names': ('blur',),
 		'regex': re.compile(r'^blur/', re.I),
 		'fn': blur, 
 		'title': 'Blur',
@@ -417,6 +501,7 @@ COMMANDS = [{
 		'format': '<tt>/blur/IMAGEURL</tt>',
 		'arguments': [ ],
 	}, {
+		'names': ('sharpen',),
 		'regex': re.compile(r'^sharpen/', re.I),
 		'fn': sharpen, 
 		'title': 'Sharpen',
@@ -425,6 +510,7 @@ COMMANDS = [{
 		'format': '<tt>/sharpen/IMAGEURL</tt>',
 		'arguments': [ ],
 	}, {
+		'names': ('convert',),
 		'regex': re.compile(r'^convert/\.?(bmp|gif|im|jpe?g|msp|pcx|pdf|png|ppm|tiff|xbm)/', re.I),
 		'fn': convert, 
 		'title': 'Convert',
@@ -435,6 +521,7 @@ COMMANDS = [{
 			('FORMAT', 'The desired image format of the created image.  Allowable values are: bmp, gif, im, jpeg/jpg, msp, pcx, pdf, png, ppm, tiff, xbm')
 		],
 	}, {
+		'names': ('background',),
 		'regex': re.compile(r'^background/(\w+)/', re.I),
 		'fn': background, 
 		'title': 'Background',
@@ -447,3 +534,8 @@ COMMANDS = [{
 	}, 
 ]
 
+
+# COMMANDS by each of the names they go by in a url, with their regexes
+# compiled so that they can match part way into a url
+COMMAND_TABLE = dict((name, (re.compile(command['regex'].pattern[1:], re.I), command['fn']))
+		for command in COMMANDS for name in command['names'])
@@ -0,0 +1,54 @@
+from django.conf import settings
+
+from urlimaging.lru import LRUCache
+
+
+def get_shared_cache(alias):
+	try:
+		from django.core.cache import caches
+		return caches[alias]
+	except ImportError:
+		# versions of django before 1.7
+		from django.core.cache import get_cache
+		return get_cache(alias)
+
+
+class LookupCache:
+	""" A cache of values which are looked up on every request.  Values are
+	    kept in a local LRU and, if IMAGE_LOOKUP_CACHE names one of the
+	    project's CACHES, in that cache so that they're shared between
+	    processes.  A value deleted in one process can be served from the
+	    local LRU of another for up to IMAGE_LOOKUP_LOCAL_TIMEOUT seconds.
+	    Without a shared cache the local LRU is all there is, so values are
+	    kept in it for as long as they're good for. """
+	def __init__(self, prefix):
+		self.prefix = 'urlimaging:%s:' % prefix
+		self.local = LRUCache(settings.IMAGE_LOOKUP_CACHE_SIZE)
+		self.shared = None
+
+
+	def get_shared(self):
+		if self.shared is None and settings.IMAGE_LOOKUP_CACHE:
+			self.shared = get_shared_cache(settings.IMAGE_LOOKUP_CACHE)
+		return self.shared
+
+	def get(self, key):
+		value = self.local.get(key)
+		if value is None and self.get_shared():
+			value = self.get_shared().get(self.prefix + key)
+			if value is not None:
+				self.local.set(key, value, settings.IMAGE_LOOKUP_LOCAL_TIMEOUT)
+
+		return value
+
+	def set(self, key, value, timeout):
+		if self.get_shared():
+			self.local.set(key, value, min(timeout, settings.IMAGE_LOOKUP_LOCAL_TIMEOUT))
+			self.get_shared().set(self.prefix + key, value, int(timeout))
+		else:
+			self.local.set(key, value, timeout)
+
+	def delete(self, key):
+		self.local.delete(key)
+		if self.get_shared():
+			self.get_shared().delete(self.prefix + key)
@@ -0,0 +1,159 @@
+import threading, time, os, errno, shutil, tempfile
+from collections import OrderedDict
+
+
+class LRUCache:
+	""" A thread-safe mapping which holds at most size items, dropping the
+	    least recently used one to make room for a new one.  Items can also
+	    be given a number of seconds after which they expire. """
+	def __init__(self, size):
+		self.size = size
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+
+
+	def get(self, key, default=None):
+		with self.lock:
+			try:
+				expires, value = self.items.pop(key)
+			except KeyError:
+				return default
+
+			if expires is not None and expires <= time.time():
+				return default
+
+			# move it to the most recently used end
+			self.items[key] = (expires, value)
+			return value
+
+	def set(self, key, value, timeout=None):
+		expires = time.time() + timeout if timeout is not None else None
+
+		with self.lock:
+			self.items.pop(key, None)
+			self.items[key] = (expires, value)
+
+			while len(self.items) > self.size:
+				self.items.popitem(last=False)
+
+	def delete(self, key):
+		with self.lock:
+			self.items.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+
+	def __len__(self):
+		return len(self.items)
+
+
+class DiskLRUCache:
+	""" A directory of files which holds at most max_bytes of them, deleting
+	    the least recently used to make room for new ones.  When they were
+	    last used is kept in their modification times, so the order survives
+	    restarts.  Other processes can share the directory, though each of
+	    them only keeps track of the files it's used.  on_evict is called with
+	    the name of each file deleted to make room. """
+	def __init__(self, directory, max_bytes, on_evict=None):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.on_evict = on_evict
+		self.files = OrderedDict()
+		self.bytes = 0
+		self.lock = threading.Lock()
+
+		try:
+			os.makedirs(directory)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+		self.load()
+
+
+	def load(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			try:
+				stat = os.stat(self.path(name))
+			except OSError:
+				continue
+			if not name.startswith('.tmp-'):
+				entries.append((stat.st_mtime, name, stat.st_size))
+
+		for mtime, name, size in sorted(entries):
+			self.add(name, size)
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	def get(self, name):
+		""" The path of the file called name, or None if it isn't cached """
+		path = self.path(name)
+		with self.lock:
+			self.forget(name)
+			try:
+				self.add(name, os.path.getsize(path))
+			except OSError:
+				return None
+
+		try:
+			os.utime(path, None)
+		except OSError:
+			pass
+
+		return path
+
+	def put(self, name, f):
+		""" Cache the contents of the file object f as name and return its path.
+		    It's written under a temporary name and renamed into place so that 
+		    it's never seen half written. """
+		path = self.path(name)
+		fd, temp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as out:
+				shutil.copyfileobj(f, out)
+			os.chmod(temp, 0o644)
+			os.rename(temp, path)
+		except:
+			os.unlink(temp)
+			raise
+
+		with self.lock:
+			self.forget(name)
+			self.add(name, os.path.getsize(path))
+			self.evict()
+
+		return path
+
+	def delete(self, name):
+		with self.lock:
+			self.forget(name)
+			try:
+				os.unlink(self.path(name))
+			except OSError:
+				pass
+
+	def add(self, name, size):
+		self.files[name] = size
+		self.bytes += size
+
+	def forget(self, name):
+		self.bytes -= self.files.pop(name, 0)
+
+	def evict(self):
+		# the file that was just added is kept even if it's bigger than max_bytes
+		while self.bytes > self.max_bytes and len(self.files) > 1:
+			name, size = self.files.popitem(last=False)
+			self.bytes -= size
+			try:
+				os.unlink(self.path(name))
+			except OSError:
+				pass
+
+			if self.on_evict:
+				self.on_evict(name)
+
+	def __len__(self):
+		return len(self.files)
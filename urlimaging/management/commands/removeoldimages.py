@@ -2,7 +2,11 @@ import datetime
 from django.conf import settings
 from django.core.management.base import NoArgsCommand
 
-from urlimaging.models import ModifiedImage
+from urlimaging.models import ModifiedImage, Job, enqueue_job, delete_images
+
+
+# the number of images deleted at once
+BATCH_SIZE = 1000
 
 
 class Command(NoArgsCommand):
@@ -10,5 +14,12 @@ class Command(NoArgsCommand):
 
 	def handle_noargs(self, **options):
 		week_ago = datetime.datetime.now() - datetime.timedelta(days=settings.IMAGE_EXPIRATION_DAYS)
-		for img in ModifiedImage.objects.filter(last_checked__lte=week_ago):
-			img.delete()
+		images = ModifiedImage.objects.filter(last_checked__lte=week_ago)
+		if settings.IMAGE_BUILD_MODE == 'queue':
+			for img in images:
+				enqueue_job(Job.DELETE, img.hash, img.get_absolute_url()[1:])
+			return
+
+		images = list(images)
+		for i in range(0, len(images), BATCH_SIZE):
+			delete_images(images[i:i + BATCH_SIZE])
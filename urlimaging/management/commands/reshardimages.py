@@ -0,0 +1,46 @@
+import os, re
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from urlimaging.backends.default import LocalImageStorage, shard_path, makedirs
+
+
+# the files LocalImageStorage saves are named by a sha224 hash
+IMAGE_NAME = re.compile(r'^[0-9a-f]{56}\.\w+$')
+
+
+class Command(NoArgsCommand):
+	help = "Move images stored by LocalImageStorage to where they belong for IMAGE_STORAGE_SHARD_DEPTH"
+
+	def handle_noargs(self, **options):
+		if not isinstance(settings.IMAGE_STORAGE, LocalImageStorage):
+			self.stdout.write("reshardimages only applies to LocalImageStorage\n")
+			return
+
+		root = settings.IMAGE_STORAGE.get_storage_dir()
+		moved = 0
+
+		# walk bottom up so that directories are emptied before they're visited
+		for directory, dirs, files in os.walk(root, topdown=False):
+			for name in files:
+				if not IMAGE_NAME.match(name):
+					continue
+
+				path = os.path.join(directory, name)
+				new_path = os.path.join(root, shard_path(name, settings.IMAGE_STORAGE_SHARD_DEPTH))
+				if path == new_path:
+					continue
+
+				makedirs(os.path.dirname(new_path))
+				os.rename(path, new_path)
+				moved += 1
+
+			if directory != root and self.is_shard(root, directory) and not os.listdir(directory):
+				os.rmdir(directory)
+
+		self.stdout.write("Moved %d images\n" % moved)
+
+	def is_shard(self, root, directory):
+		""" Only directories named like shards are removed, so nothing else that
+		    happens to be in the storage directory is touched """
+		return all(re.match(r'^[0-9a-f]{2}$', part) for part in os.path.relpath(directory, root).split(os.sep))
@@ -0,0 +1,52 @@
+import sys, time, threading, traceback
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from urlimaging.models import claim_job, run_job
+
+
+class Command(BaseCommand):
+	help = "Build, check and delete images which have been queued by requests"
+
+	option_list = BaseCommand.option_list + (
+		make_option('--concurrency', dest='concurrency', type='int', default=1,
+			help='The number of jobs to run at once'),
+		make_option('--sleep', dest='sleep', type='float', default=1.0,
+			help='Seconds to wait before looking again when the queue is empty'),
+		make_option('--once', dest='once', action='store_true', default=False,
+			help='Exit once the queue is empty rather than waiting for more jobs'),
+	)
+
+	def handle(self, *args, **options):
+		threads = []
+		for i in range(options['concurrency']):
+			thread = threading.Thread(target=self.work, args=(options['sleep'], options['once']))
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+
+		# joining with a timeout lets ctrl-c through
+		while any(thread.is_alive() for thread in threads):
+			for thread in threads:
+				thread.join(1)
+
+	def work(self, sleep, once):
+		try:
+			while True:
+				try:
+					job = claim_job()
+				except:
+					traceback.print_exc(file=sys.stderr)
+					job = None
+
+				if job:
+					if not run_job(job):
+						print >>sys.stderr, "Job failed: %s (%s)" % (job, job.error)
+				elif once:
+					return
+				else:
+					time.sleep(sleep)
+		finally:
+			connection.close()
@@ -1,11 +1,19 @@
-import urllib, urllib2, os, hashlib, re, datetime
+import urllib, urllib2, httplib, socket, os, shutil, tempfile, hashlib, re, datetime, time, calendar
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
+from django.utils.http import parse_http_date_safe
 
 from urlimaging.image import *
+from urlimaging.pipeline import run_pipelines
+from urlimaging.backends.processing import ImageProcessingException
+from urlimaging.background import run_in_background
+from urlimaging.lru import LRUCache
+from urlimaging.lookup import LookupCache
+from urlimaging.originals import OriginalCache
+from urlimaging.fetcher import Fetcher
 
 
 LATIN_ASCII_MAP = { 
@@ -26,16 +34,10 @@ LATIN_ASCII_MAP = {
 }
 
 
+NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
 def latin1_to_ascii(uni):
-	r = ''
-	for i in uni:
-		if LATIN_ASCII_MAP.has_key(ord(i)):
-			r += LATIN_ASCII_MAP[ord(i)]
-		elif ord(i) >= 0x80:
-			pass
-		else:
-			r += str(i)
-	return r
+	return str(NON_ASCII.sub(lambda m: LATIN_ASCII_MAP.get(ord(m.group()), ''), uni))
 
 
 
@@ -57,6 +59,152 @@ class Site(models.Model):
 		return self.domain_name
 
 
+def now():
+	if settings.USE_TZ:
+		return timezone.make_aware(datetime.datetime.now(), timezone.get_default_timezone())
+	return datetime.datetime.now()
+
+
+# Site rows by domain name and the urls of images which don't need checking by hash
+SITES = LookupCache('site')
+IMAGE_URLS = LookupCache('image')
+
+# seconds to cache a Site for
+SITE_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+# urls which recently failed, so they aren't tried again on every request
+FAILURES = LookupCache('failure')
+
+
+def failure_key(url):
+	return hashlib.sha224(url.encode('utf8') if isinstance(url, unicode) else url).hexdigest()
+
+
+def remember_failure(url, failure):
+	""" Remember that url failed in the given way for as long as
+	    IMAGE_NEGATIVE_CACHE_TTLS says to.  Returns the failure and the time
+	    (as from time.time()) until which it's remembered. """
+	ttl = settings.IMAGE_NEGATIVE_CACHE_TTLS.get(failure, 0)
+	remembered = (failure, time.time() + ttl)
+	if ttl > 0:
+		FAILURES.set(failure_key(url), remembered, ttl)
+	return remembered
+
+
+def recent_failure(url):
+	""" The failure remembered for url and until when, or None """
+	return FAILURES.get(failure_key(url))
+
+
+def get_site(domain):
+	""" The Site for a domain name, which is created if it doesn't exist yet """
+	site = SITES.get(domain)
+	if site is not None:
+		return site
+
+	try:
+		site = Site.objects.get(domain_name=domain)
+
+	except Site.DoesNotExist:
+		try:
+			with transaction.atomic():
+				site = Site(domain_name=domain)
+				site.save()
+		except IntegrityError:
+			# somebody else just created it
+			site = Site.objects.get(domain_name=domain)
+
+	SITES.set(domain, site, SITE_CACHE_TIMEOUT)
+	return site
+
+
+def image_location(image):
+	""" Where an image is in storage: its url, the time (as from time.time())
+	    until which that url can be used without checking the image, and
+	    whether the url is stable, i.e. doesn't stop working at some point.
+	    Along with that goes what's needed to answer conditional requests for
+	    it: its etag, size and when it was generated.  It's cached until the
+	    url can't be used, so that until then it can be returned without
+	    going to the database. """
+	url = settings.IMAGE_STORAGE.get_image_url(image)
+	expires = time.time() + image.check_interval() + \
+			(image.last_checked - now()).total_seconds()
+
+	url_expires = settings.IMAGE_STORAGE.get_url_expiry(image)
+	if url_expires is not None:
+		expires = min(expires, url_expires)
+
+	location = {'url': url, 'expires': expires, 'stable': url_expires is None,
+			'etag': image.etag(), 'size': image.size, 'generated': None}
+	if image.generated and timezone.is_aware(image.generated):
+		location['generated'] = calendar.timegm(image.generated.utctimetuple())
+	elif image.generated:
+		location['generated'] = time.mktime(image.generated.timetuple())
+
+	fresh_for = expires - time.time()
+	if fresh_for >= 1:
+		IMAGE_URLS.set(image.hash, location, fresh_for)
+
+	return location
+
+
+def freshness(headers):
+	""" The number of seconds a response from an original's server says it can
+	    be cached for, from its Cache-Control or Expires headers, kept between
+	    IMAGE_MIN_CHECK_INTERVAL and IMAGE_MAX_CHECK_INTERVAL.  None if it 
+	    doesn't say. """
+	if headers is None:
+		return None
+
+	cache_control = (headers.getheader('cache-control') or '').lower()
+	max_age = re.search(r'(?:^|[\s,])max-age\s*=\s*"?(\d+)', cache_control)
+	expires = headers.getheader('expires')
+
+	if 'no-cache' in cache_control or 'no-store' in cache_control:
+		seconds = 0
+	elif max_age:
+		seconds = int(max_age.group(1))
+	elif expires:
+		# an invalid Expires, like 0, means it's already expired
+		date = parse_http_date_safe(headers.getheader('date') or '') or time.time()
+		seconds = (parse_http_date_safe(expires) or date) - date
+	else:
+		return None
+
+	return int(max(settings.IMAGE_MIN_CHECK_INTERVAL, min(seconds, settings.IMAGE_MAX_CHECK_INTERVAL)))
+
+
+class BuildLock(models.Model):
+	""" Held by the worker that's building or checking the image with the given hash """
+	hash = models.CharField(max_length=56, unique=True, db_index=True)
+	acquired = models.DateTimeField()
+
+	def __unicode__(self):
+		return self.hash
+
+
+def acquire_build_lock(hash):
+	""" Take the lock on building the image with the given hash, returning False
+	    if another worker already has it.  Locks older than IMAGE_BUILD_LOCK_TIMEOUT
+	    seconds are assumed to belong to a worker which died and are broken. """
+	now = timezone.now()
+	BuildLock.objects.filter(hash=hash, acquired__lt=now - \
+			datetime.timedelta(seconds=settings.IMAGE_BUILD_LOCK_TIMEOUT)).delete()
+
+	try:
+		with transaction.atomic():
+			BuildLock(hash=hash, acquired=now).save()
+	except IntegrityError:
+		return False
+
+	return True
+
+
+def release_build_lock(hash):
+	BuildLock.objects.filter(hash=hash).delete()
+
+
 class ModifiedImage(models.Model):
 	hash = models.CharField(max_length=56, unique=True, db_index=True) 
 	ext = models.CharField(max_length=10, db_index=True)
@@ -67,10 +215,15 @@ class ModifiedImage(models.Model):
 	original_file_hash = models.CharField(max_length=56)
 	site = models.ForeignKey(Site)
 	size = models.PositiveIntegerField(default=0)
+	generated = models.DateTimeField(null=True)
+	original_etag = models.CharField(max_length=255, null=True)
+	# seconds the original's server said it could be cached for, if it did
+	fresh_for = models.PositiveIntegerField(null=True)
 
 
 	def delete(self):
-		settings.IMAGE_STORAGE.delete_image(image)
+		IMAGE_URLS.delete(self.hash)
+		settings.IMAGE_STORAGE.delete_image(self)
 
 		models.Model.delete(self)
 
@@ -86,6 +239,15 @@ class ModifiedImage(models.Model):
 	def get_absolute_url(self):
 		return '/' + self.operations + self.site.domain_name + self.original_location
 
+	def check_interval(self):
+		""" Seconds after it's checked that the original is due to be checked again """
+		return self.fresh_for if self.fresh_for is not None else settings.IMAGE_CHECK_INTERVAL
+
+	def etag(self):
+		""" Identifies the contents of the image, which are decided by the commands
+		    and the original image """
+		return '%s-%s' % (self.hash[:24], self.original_file_hash[:24])
+
 	def hashed_filename(self):
 		return "%s%s" % (self.hash, self.ext)
 
@@ -93,6 +255,98 @@ class ModifiedImage(models.Model):
 		return self.get_absolute_url()
 
 
+def delete_images(images):
+	""" Delete a number of images, along with their stored copies, in as few
+	    requests to the storage backend and queries as possible """
+	for image in images:
+		IMAGE_URLS.delete(image.hash)
+	settings.IMAGE_STORAGE.delete_images(images)
+
+	ModifiedImage.objects.filter(id__in=[image.id for image in images]).delete()
+
+
+class Job(models.Model):
+	""" Work on an image waiting to be done by the urlimaging_worker command """
+	BUILD, REVALIDATE, DELETE = 'build', 'revalidate', 'delete'
+	KIND_CHOICES = ((BUILD, 'Build'), (REVALIDATE, 'Revalidate'), (DELETE, 'Delete'))
+
+	PENDING, RUNNING, FAILED = 'pending', 'running', 'failed'
+	STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (FAILED, 'Failed'))
+
+	kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+	hash = models.CharField(max_length=56, db_index=True)
+	url = models.CharField(max_length=4096)
+	status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+	created = models.DateTimeField(db_index=True)
+	started = models.DateTimeField(null=True)
+	attempts = models.PositiveIntegerField(default=0)
+	error = models.TextField(blank=True)
+
+
+	def run(self):
+		if self.kind == Job.DELETE:
+			for image in ModifiedImage.objects.filter(hash=self.hash):
+				image.delete()
+			return
+
+		cr = CommandRunner(self.url)
+		if not cr.todo:
+			raise ValueError('Unable to parse url: %s' % self.url)
+
+		try:
+			image = ModifiedImage.objects.get(hash=cr.hash)
+		except ModifiedImage.DoesNotExist:
+			image = None
+
+		cr.build(image)
+
+	def __unicode__(self):
+		return '%s %s' % (self.kind, self.url)
+
+
+def enqueue_job(kind, hash, url):
+	""" Add a job to the queue unless the same one is already waiting """
+	if not Job.objects.filter(kind=kind, hash=hash, status=Job.PENDING).exists():
+		Job(kind=kind, hash=hash, url=url, created=timezone.now()).save()
+
+
+def claim_job():
+	""" Take the oldest pending job off of the queue, or None if there isn't one.
+	    Jobs which have been running for longer than IMAGE_BUILD_LOCK_TIMEOUT are
+	    assumed to belong to a worker which died and are put back on the queue,
+	    unless they've been attempted IMAGE_JOB_ATTEMPTS times, as a job which
+	    keeps killing its worker would. """
+	now = timezone.now()
+	abandoned = Job.objects.filter(status=Job.RUNNING, started__lt=now - \
+			datetime.timedelta(seconds=settings.IMAGE_BUILD_LOCK_TIMEOUT))
+	abandoned.filter(attempts__lt=settings.IMAGE_JOB_ATTEMPTS).update(status=Job.PENDING)
+	abandoned.filter(attempts__gte=settings.IMAGE_JOB_ATTEMPTS) \
+			.update(status=Job.FAILED, error='The worker running it died')
+
+	for job in Job.objects.filter(status=Job.PENDING).order_by('created')[:10]:
+		# somebody else may have claimed it since it was looked up
+		if Job.objects.filter(id=job.id, status=Job.PENDING) \
+				.update(status=Job.RUNNING, started=now, attempts=models.F('attempts') + 1):
+			return Job.objects.get(id=job.id)
+
+	return None
+
+
+def run_job(job):
+	""" Run a claimed job, removing it from the queue if it worked.  A job which
+	    fails is retried until it's been attempted IMAGE_JOB_ATTEMPTS times. """
+	try:
+		job.run()
+	except Exception as e:
+		job.error = repr(e)
+		job.status = Job.FAILED if job.attempts >= settings.IMAGE_JOB_ATTEMPTS else Job.PENDING
+		job.save()
+		return False
+
+	job.delete()
+	return True
+
+
 # XXX use a setting for the directory
 def file_location(hash, ext):
 	return '/tmp/' + hash + ext
@@ -107,103 +361,238 @@ def valid_image_path(url):
 	return re.match(r'^(http://?)?[\w\-\.]+\.\w+(\:\d+){0,1}/.+$', url, re.I)
 
 
+def expand_preset(url):
+	""" Replace preset/<name>/ at the start of url with the commands that
+	    IMAGE_PRESETS has for name, which is matched exactly as it's written
+	    there.  Other urls are returned as they are. """
+	m = re.match(r'^preset/([\w\-]+)/', url)
+	if not m or m.group(1) not in settings.IMAGE_PRESETS:
+		return url
+
+	return settings.IMAGE_PRESETS[m.group(1)].strip('/') + '/' + url[m.end():]
+
+
+def parse_commands(url):
+	""" Parse the commands off of the front of url in a single pass, looking
+	    each one up by the first part of its path.  Returns the commands to
+	    run, the operations part of the url, the sanitized url of the image,
+	    its extension, hash and working filename.  If url can't be parsed, 
+	    there are no commands to run.  A preset is parsed as the commands it
+	    stands for, so it's the same image as when they're given in full. """
+	url = expand_preset(url)
+	todo, operations, pos = [], '', 0
+
+	while True:
+		end = url.find('/', pos)
+		command = COMMAND_TABLE.get(url[pos:end].lower()) if end != -1 else None
+		if not command:
+			break
+
+		m = command[0].match(url, pos)
+		if not m:
+			break
+
+		operations += m.group().lower()
+		todo.append((command[1], m.groups()))
+		pos = m.end()
+
+	url = url[pos:]
+	if not todo or not valid_image_path(url):
+		return [], '', '', '', '', ''
+
+	ext = os.path.splitext(re.sub(r'\?.+$', '', url))[-1]
+	if not ext:
+		ext = '.jpg'
+
+	# a converted image is stored with the extension of the format it's converted to
+	for fn, args in todo:
+		if fn is convert:
+			ext = converted_extension(args[0])
+
+	hash = hashlib.sha224(operations + latin1_to_ascii(url)).hexdigest()
+	return todo, operations, sanitize_url(url), ext, hash, file_location(hash, ext)
+
+
+# recently parsed urls, since they're parsed for every request
+PARSED_URLS = LRUCache(settings.IMAGE_PARSE_CACHE_SIZE)
+
+# downloaded originals, shared by all of the images built from them
+ORIGINALS = OriginalCache(settings.IMAGE_ORIGINAL_CACHE_DIR, settings.IMAGE_ORIGINAL_CACHE_BYTES) \
+		if settings.IMAGE_ORIGINAL_CACHE_DIR else None
+
+
+# fetches originals over connections which are kept open between fetches
+FETCHER = Fetcher()
+
+
+# originals are rejected if their headers can't be read from this many bytes
+PROBE_BYTES = 256 * 1024
+
+
+# how often to look for an image that another worker is building, in seconds
+BUILD_POLL_INTERVAL = 0.1
+
+
 class ImageNotFoundException(Exception):
+	# the kind of failure, which decides how long it's remembered for (see 
+	# IMAGE_NEGATIVE_CACHE_TTLS)
+	failure = 'not_found'
+
+
+class NotAnImageException(ImageNotFoundException):
+	""" The original isn't an image, or not one that can be processed """
+	failure = 'not_image'
+
+
+class ImageTooLargeException(NotAnImageException):
+	""" The original is bigger than IMAGE_MAX_BYTES or IMAGE_MAX_PIXELS """
+	pass
+
+
+class ImageUnavailableException(Exception):
+	""" The original's server is down or too slow, and there's no previous 
+	    copy of the image to use instead """
+	failure = 'unavailable'
+
+
+class ImagePendingException(Exception):
+	""" The image has been queued to be built but isn't ready yet """
 	pass
 
 
 class CommandRunner:
 	def __init__(self, url=None):
 		self.todo = []
+		self.path = ""
 		self.url = ""
 		self.filename = ""
 		self.ext = ""
 		self.hash = ""
 		self.operations = ""
+		self.location = None
 
 		if url: self.parse_url(url)
 
 
 	def parse_url(self, url):
-		did_op = True
-
-		# apply the operations to the url until none are left
-		while did_op:
-			did_op = False
-			for op in COMMANDS:
-				m = re.match(op['regex'], url)
-				if m:
-					self.operations += m.group().lower()
-					self.todo.append((op['fn'], m.groups()))
-					url = re.sub(op['regex'], '', url)
-					did_op = True
-					break
-
-
-		if self.todo and valid_image_path(url):
-			self.url = sanitize_url(url)
-			self.ext = os.path.splitext(re.sub(r'\?.+$', '', url))[-1]
-			if not self.ext:
-				self.ext = '.jpg'
-
-			self.hash = hashlib.sha224(self.operations + latin1_to_ascii(url)).hexdigest()
-			self.filename = file_location(self.hash, self.ext)
-		else:
-			self.todo = []
+		self.path = url
+
+		parsed = PARSED_URLS.get(url)
+		if parsed is None:
+			parsed = parse_commands(url)
+			PARSED_URLS.set(url, parsed)
+
+		todo, self.operations, self.url, self.ext, self.hash, self.filename = parsed
+		self.todo = list(todo)
 
 
 	def get_image(self, image):
 		""" Get the image and return true or false if it's changed or not.  It can tell
 		    if it's been used by either using the last-modified header saved from a previous
 		    request, or if that doesn't exist, it compares a hash of the file's contents """
-		image.last_checked = datetime.datetime.now()
+		image.last_checked = now()
 		# if it exists, always save here that it's been checked
 		if image.id: image.save()
 
-		request = urllib2.Request(self.url)
+		# another image built from the same original may have downloaded it recently
+		cached = ORIGINALS.get(self.url) if ORIGINALS else None
+		if cached and time.time() - cached['checked'] < (settings.IMAGE_CHECK_INTERVAL \
+				if cached.get('fresh_for') is None else cached['fresh_for']):
+			changed = self.use_original(image, cached)
+			if changed is not None:
+				return changed
 
-		if image.last_modified:
-			request.add_header('If-Modified-Since', image.last_modified)
+		headers = {}
+
+		# when there's a cached copy ask whether it's changed, so it can be used if it hasn't
+		last_modified, etag = (cached['last_modified'], cached.get('etag')) if cached \
+				else (image.last_modified, image.original_etag)
+		if last_modified:
+			headers['If-Modified-Since'] = last_modified
+		if etag:
+			headers['If-None-Match'] = etag
 
 		try:
-			remote = urllib2.build_opener().open(request)
+			remote = FETCHER.fetch(self.url, headers, domain_name(self.url))
 		except urllib2.HTTPError as e:
 			if e.code >= 400 and e.code < 500: raise ImageNotFoundException()
+
 			# 304 Not Modified
-			return False
+			if e.code == 304 and cached:
+				cached['fresh_for'] = freshness(e.hdrs)
+				ORIGINALS.checked(self.url, cached)
+				changed = self.use_original(image, cached)
+				if changed is not None:
+					return changed
+			elif e.code == 304:
+				image.fresh_for = freshness(e.hdrs)
+				return False
+
+			return self.unavailable(image)
 		except urllib2.URLError as e:
 			# requesting host down?
-			return False
+			return self.unavailable(image)
 
-		content_type = remote.info().getheader('content-type').lower()
+		content_type = (remote.info().getheader('content-type') or '').lower()
 		if not content_type.startswith('image/') \
 				and not content_type.endswith("/octet-stream"):
 			remote.close()
-			raise ImageNotFoundException()
+			raise NotAnImageException()
+
+		length = remote.info().getheader('content-length')
+		if length and length.isdigit() and int(length) > settings.IMAGE_MAX_BYTES:
+			remote.close()
+			raise ImageTooLargeException()
 
 		hasher = hashlib.sha224()
 		local = open(self.filename, 'w')
 
-		# read file in 4K chunks and make a hash of it
-		size = 0
-		while True:
-			chunk = remote.read(4096)
-			if not chunk: break
+		# read file in 4K chunks and make a hash of it.  until its header has
+		# been read the start of it is kept in probe, to check its dimensions
+		# before downloading any more of it than that
+		size, probe = 0, ''
+		try:
+			while True:
+				chunk = remote.read(4096)
+				if not chunk: break
 
-			size += len(chunk)
+				size += len(chunk)
+				if size > settings.IMAGE_MAX_BYTES:
+					raise ImageTooLargeException()
 
-			# don't process images larger than 10 MBS
-			if size > TEN_MBS: return False
+				local.write(chunk)
+				hasher.update(chunk)
 
-			local.write(chunk)
-			hasher.update(chunk)
+				if probe is not None:
+					probe = self.check_header(probe + chunk)
+
+			if probe is not None:
+				raise NotAnImageException()
+		except ImageNotFoundException:
+			local.close()
+			os.unlink(self.filename)
+			raise
+		except (urllib2.URLError, socket.error, httplib.HTTPException):
+			# the original took too long or the connection was lost
+			local.close()
+			os.unlink(self.filename)
+			return self.unavailable(image)
+		finally:
+			remote.close()
 
 		local.close()
-		remote.close()
 
 		remote_file_hash = hasher.hexdigest()
+		validators = {'last_modified': remote.info().getheader('last-modified'),
+				'etag': remote.info().getheader('etag'),
+				'fresh_for': freshness(remote.info())}
+		if ORIGINALS:
+			ORIGINALS.put(self.url, self.filename, remote_file_hash, validators)
+
 		if image.original_file_hash == remote_file_hash:
 			# compared the hashes and they are still the same (no change)
 			os.unlink(self.filename)
+			self.set_validators(image, validators)
 			return False
 
 		# if it's changed, delete the previous
@@ -211,53 +600,333 @@ class CommandRunner:
 			image.delete()
 
 		image.original_file_hash = remote_file_hash
-		image.last_modified = remote.info().getheader('last-modified')
+		self.set_validators(image, validators)
 
 		return True
 
 
+	def unavailable(self, image):
+		""" When the original can't be fetched, an existing image is kept as it
+		    is, but there's nothing to build a new one from """
+		if not image.original_file_hash:
+			raise ImageUnavailableException()
+		return False
+
+
+	def set_validators(self, image, validators):
+		""" Keep what's needed to ask the original's server whether it's 
+		    changed, and how long until it needs to be asked """
+		image.last_modified = validators['last_modified']
+		image.original_etag = validators.get('etag')
+		image.fresh_for = validators.get('fresh_for')
+
+
+	def check_header(self, probe):
+		""" Check the dimensions of the original from the start of it, before
+		    it's downloaded and decoded, so that a small file which decodes to
+		    a huge image can't use up all of the memory.  Returns None once the
+		    header has been read, otherwise probe to be added to. """
+		header = image_header(probe)
+		if header:
+			width, height = header[1]
+			if width * height > settings.IMAGE_MAX_PIXELS:
+				raise ImageTooLargeException()
+			return None
+
+		if len(probe) >= PROBE_BYTES:
+			# this much of any image we can process is enough to read its header
+			raise NotAnImageException()
+		return probe
+
+
+	def use_original(self, image, cached):
+		""" Like get_image(), but using the copy of the original in ORIGINALS.
+		    Returns None if the copy has gone, so it has to be downloaded. """
+		if image.original_file_hash == cached['hash']:
+			self.set_validators(image, cached)
+			return False
+
+		try:
+			shutil.copyfile(cached['path'], self.filename)
+		except IOError:
+			return None
+
+		if image.id:
+			image.delete()
+
+		image.original_file_hash = cached['hash']
+		self.set_validators(image, cached)
+
+		return True
+
+
+	def new_image(self):
+		""" A ModifiedImage for this url which hasn't been built yet """
+		image = ModifiedImage(hash=self.hash, \
+				original_location=url_path(self.url), \
+				operations=self.operations, ext=self.ext)
+
+		image.site = get_site(domain_name(self.url))
+		return image
+
+
+	def checked_within(self, image, seconds):
+		return image.last_checked >= now() - datetime.timedelta(seconds=seconds)
+
+
+	def needs_check(self, image):
+		""" Whether it's time to check the original image for changes """
+		return not self.checked_within(image, image.check_interval())
+
+
+	def can_serve_stale(self, image):
+		""" Whether the image can be returned while it's checked in the background,
+		    which is for IMAGE_MAX_STALENESS seconds after it was due to be checked """
+		return settings.IMAGE_STALE_WHILE_REVALIDATE \
+				and self.checked_within(image, image.check_interval() + settings.IMAGE_MAX_STALENESS)
+
+
+	def image_url(self, image):
+		""" The url of an image in storage, keeping track of its location """
+		self.location = image_location(image)
+		return self.location['url']
+
+
+	def wait_for_image(self, seconds):
+		""" Wait up to the given number of seconds for another worker to finish
+		    building the image.  Returns its url, or None if it isn't done. """
+		give_up = time.time() + seconds
+		while True:
+			try:
+				return self.image_url(ModifiedImage.objects.get(hash=self.hash))
+			except ModifiedImage.DoesNotExist:
+				pass
+
+			if time.time() >= give_up:
+				return None
+			time.sleep(BUILD_POLL_INTERVAL)
+
+
 	def run_commands(self, user=None):
-		check_remote_image = False
+		cached = IMAGE_URLS.get(self.hash)
+		if cached:
+			self.location = cached
+			return cached['url']
+
 		try:
 			image = ModifiedImage.objects.get(hash=self.hash)	
 		except ModifiedImage.DoesNotExist:
-			# need to create the image
-			image = ModifiedImage(hash=self.hash, \
-					original_location=url_path(self.url), \
-					operations=self.operations, ext=self.ext)
+			image = None
+		else:
+			if not self.needs_check(image):
+				return self.image_url(image)
 
-			# do we need to create the domain too?
-			try:
-				site = Site.objects.get(domain_name=domain_name(self.url))
+			if settings.IMAGE_BUILD_MODE == 'queue':
+				enqueue_job(Job.REVALIDATE, self.hash, self.path)
+				return self.image_url(image)
 
-			except Site.DoesNotExist:
-				site = Site(domain_name=domain_name(self.url))
-				site.save()
+			if self.can_serve_stale(image):
+				run_in_background(self.hash, self.build, image)
+				return self.image_url(image)
 
-			image.site = site
-			check_remote_image = True
-		else:
-			if settings.USE_TZ:
-				two_hours_ago = timezone.make_aware(datetime.datetime.now(), timezone.get_default_timezone()) - datetime.timedelta(hours=2)
-			else:
-				two_hours_ago = datetime.datetime.now() - datetime.timedelta(hours=2)
-			check_remote_image = image.last_checked < two_hours_ago
+		if settings.IMAGE_BUILD_MODE == 'queue':
+			enqueue_job(Job.BUILD, self.hash, self.path)
 
+			url = self.wait_for_image(settings.IMAGE_QUEUE_WAIT)
+			if not url:
+				raise ImagePendingException()
+			return url
 
-		if check_remote_image and self.get_image(image):
-			# apply all of the transformations
-			for fn, group in self.todo:
-				try: 
-					fn(self.filename, *group)
-				except ValueError as e:
-					break
+		return self.build(image)
 
-			settings.IMAGE_STORAGE.save_image(image, self.filename)
-			image.size = os.path.getsize(self.filename)
 
-			os.unlink(self.filename)
+	def build(self, image=None):
+		""" Check the original and (re)build the image if it has changed or
+		    hasn't been built yet, returning its url.  image is the current copy,
+		    if there is one. """
+		# only one worker at a time builds or checks a given image.  while an 
+		# existing image is being checked the current copy is still good to use
+		if not acquire_build_lock(self.hash):
+			if image:
+				return self.image_url(image)
 
-		if check_remote_image:
-			image.save()
+			url = self.wait_for_image(settings.IMAGE_BUILD_WAIT)
+			if not url:
+				raise ImageProcessingException('Timed out waiting for %s to be built' % self.url)
+			return url
 
-		return settings.IMAGE_STORAGE.get_image_url(image)
+		try:
+			# it may have been built or checked while we were getting the lock
+			try:
+				image = ModifiedImage.objects.get(hash=self.hash)
+				check_remote_image = self.needs_check(image)
+			except ModifiedImage.DoesNotExist:
+				image = self.new_image()
+				check_remote_image = True
+
+			if check_remote_image and self.get_image(image):
+				# apply all of the transformations
+				if settings.IMAGE_PIPELINE:
+					try:
+						settings.IMAGE_PROCESSOR.process(self.filename, self.todo)
+					except:
+						os.unlink(self.filename)
+						raise
+				else:
+					for fn, group in self.todo:
+						try: 
+							fn(self.filename, *group)
+						except ValueError as e:
+							break
+
+				settings.IMAGE_STORAGE.save_image(image, self.filename)
+				image.size = os.path.getsize(self.filename)
+				image.generated = now()
+
+				os.unlink(self.filename)
+
+			if check_remote_image:
+				image.save()
+		finally:
+			release_build_lock(self.hash)
+
+		return self.image_url(image)
+
+
+def srcset_paths(url, widths):
+	""" The urls (without the leading /) of an image scaled to each of widths,
+	    after whatever commands are at the start of url, largest first """
+	todo, operations = parse_commands('width/1/' + url)[:2]
+	if not todo:
+		return []
+
+	# the commands found after the width we added, and the image they're run on
+	operations = operations[len('width/1/'):]
+	image = url[len(operations):]
+
+	return [operations + 'width/%d/' % w + image for w in sorted(set(widths), reverse=True)]
+
+
+def build_derivatives(paths):
+	""" Build a number of images from the same original in one go, which is
+	    downloaded and decoded once (see pipeline.run_pipelines()).  Images 
+	    which don't need to be checked, or which another worker is building, 
+	    are left alone.  Returns a CommandRunner for each of paths. """
+	runners = [CommandRunner(path) for path in paths]
+	if not runners or any(not cr.todo or cr.url != runners[0].url for cr in runners):
+		raise ValueError('Derivatives must be built from a single original')
+
+	to_build = []
+	try:
+		for cr in runners:
+			try:
+				image = ModifiedImage.objects.get(hash=cr.hash)
+				if not cr.needs_check(image):
+					continue
+			except ModifiedImage.DoesNotExist:
+				image = cr.new_image()
+
+			if acquire_build_lock(cr.hash):
+				to_build.append((cr, image))
+
+		if to_build:
+			build_from_original(to_build)
+	finally:
+		for cr, image in to_build:
+			release_build_lock(cr.hash)
+
+	return runners
+
+
+def build_from_original(to_build):
+	""" Download the original shared by a list of (CommandRunner, ModifiedImage)
+	    pairs and rebuild the ones it's changed for """
+	lead = to_build[0][0]
+
+	# an image without validators, so the original is always fetched
+	original = ModifiedImage()
+	if not lead.get_image(original):
+		return
+
+	fd, source = tempfile.mkstemp(suffix=lead.ext)
+	os.close(fd)
+	os.rename(lead.filename, source)
+
+	try:
+		changed = []
+		for cr, image in to_build:
+			image.last_checked = now()
+			if image.original_file_hash != original.original_file_hash:
+				if image.id:
+					image.delete()
+				image.original_file_hash = original.original_file_hash
+				image.last_modified = original.last_modified
+				image.original_etag = original.original_etag
+				image.fresh_for = original.fresh_for
+				changed.append((cr, image))
+
+		if changed:
+			run_pipelines(source, [cr.todo for cr, image in changed], 
+					[cr.filename for cr, image in changed])
+
+		for cr, image in changed:
+			settings.IMAGE_STORAGE.save_image(image, cr.filename)
+			image.size = os.path.getsize(cr.filename)
+			image.generated = now()
+			os.unlink(cr.filename)
+
+		with transaction.atomic():
+			for cr, image in to_build:
+				image.save()
+	finally:
+		os.unlink(source)
+		for cr, image in to_build:
+			if os.path.exists(cr.filename):
+				os.unlink(cr.filename)
+
+
+def prewarm(url, presets=None):
+	""" Build the image at url (without the http://) for each of presets, or
+	    all of IMAGE_PRESETS, before anyone asks for them.  They're queued
+	    for urlimaging_worker when IMAGE_BUILD_MODE is 'queue', otherwise 
+	    they're all built together in a background thread, downloading the
+	    original only once. """
+	runners = []
+	for name in presets or settings.IMAGE_PRESETS.keys():
+		cr = CommandRunner('preset/%s/%s' % (name, url))
+		if cr.todo and settings.IMAGE_WHITELIST_FN(cr.url):
+			runners.append(cr)
+
+	if not runners:
+		return
+
+	if settings.IMAGE_BUILD_MODE == 'queue':
+		for cr in runners:
+			enqueue_job(Job.BUILD, cr.hash, cr.path)
+	else:
+		run_in_background(' '.join(cr.hash for cr in runners), build_derivatives, 
+				[cr.path for cr in runners])
+
+
+def prewarm_on_save(sender, instance, **kwargs):
+	""" A post_save signal handler which prewarms the images in any of the 
+	    model's file fields which have absolute urls """
+	for field in instance._meta.fields:
+		if not isinstance(field, models.FileField):
+			continue
+
+		f = getattr(instance, field.name)
+		if not f:
+			continue
+
+		url = re.sub(r'^https?://', '', f.url)
+		if url != f.url:
+			prewarm(url)
+
+
+def connect_prewarm(model):
+	""" Prewarm the images in model's file fields whenever it's saved.  Call
+	    this with each model that has images that should have presets built,
+	    e.g. in its models.py. """
+	models.signals.post_save.connect(prewarm_on_save, sender=model, weak=False,
+			dispatch_uid='urlimaging.prewarm.%s.%s' % (model._meta.app_label, model.__name__))
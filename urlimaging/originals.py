@@ -0,0 +1,78 @@
+import os, errno, hashlib, json, tempfile, time
+
+from urlimaging.lru import DiskLRUCache
+
+
+class OriginalCache:
+	""" Original images downloaded by CommandRunner.get_image(), kept on disk
+	    so that building another image from the same original doesn't mean
+	    downloading it again.  Next to each is the hash of its contents, its
+	    Last-Modified and ETag headers, how long its server said it could be
+	    cached for and when it was last checked for changes. """
+	def __init__(self, directory, max_bytes):
+		self.files = DiskLRUCache(os.path.join(directory, 'files'), max_bytes, self.delete_meta)
+		self.meta_dir = os.path.join(directory, 'meta')
+
+		try:
+			os.makedirs(self.meta_dir)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+
+	def key(self, url):
+		return hashlib.sha224(url).hexdigest()
+
+	def meta_path(self, key):
+		return os.path.join(self.meta_dir, key + '.json')
+
+	def delete_meta(self, key):
+		try:
+			os.unlink(self.meta_path(key))
+		except OSError:
+			pass
+
+	def get(self, url):
+		""" A dict of the hash, validators and checked time of the cached 
+		    original from url, along with its path, or None if there isn't one """
+		key = self.key(url)
+		path = self.files.get(key)
+		if not path:
+			# the original may have been evicted by another process
+			self.delete_meta(key)
+			return None
+
+		try:
+			with open(self.meta_path(key)) as f:
+				meta = json.load(f)
+		except (IOError, ValueError):
+			return None
+
+		meta['path'] = path
+		return meta
+
+	def put(self, url, filename, hash, validators):
+		""" Cache the original from url, which has been downloaded to filename,
+		    along with the hash of its contents and a dict of its last_modified,
+		    etag and how many seconds it's fresh_for """
+		key = self.key(url)
+		with open(filename, 'rb') as f:
+			self.files.put(key, f)
+		self.write_meta(key, dict(validators, hash=hash))
+
+	def checked(self, url, meta):
+		""" Record that the original from url was found not to have changed """
+		self.write_meta(self.key(url), meta)
+
+	def write_meta(self, key, meta):
+		meta = dict(meta, checked=time.time())
+		meta.pop('path', None)
+
+		fd, temp = tempfile.mkstemp(dir=self.meta_dir, prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(meta, f)
+			os.rename(temp, self.meta_path(key))
+		except:
+			os.unlink(temp)
+			raise
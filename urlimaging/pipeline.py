@@ -0,0 +1,155 @@
+from io import BytesIO
+from PIL import Image
+
+from urlimaging.image import encode_image, output_format, convert, crop_box, resample, width
+from urlimaging.planner import plan
+
+
+# an image is never shrunk while decoding to less than this many times the size
+# it's about to be resampled to, so the resample still has pixels to antialias
+REDUCING_GAP = 2.0
+
+
+def apply_commands(img, todo):
+	""" Apply each (fn, args) pair from a CommandRunner's todo list to an image
+	    which has already been decoded.  Just like running the commands one at a
+	    time, a ValueError stops processing and keeps whatever has been done so far.
+
+	    Returns the resulting image and the format it should be encoded as, which
+	    is None unless a convert command was given. """
+	format = None
+
+	for fn, args in todo:
+		try:
+			result = fn.transform(img, *args)
+		except ValueError:
+			break
+
+		if fn is convert:
+			format = output_format(args[0])
+
+		# commands like background return None when they can't do anything
+		if result is not None:
+			img = result
+
+	return img, format
+
+
+def reduction(planned, size):
+	""" The integer factor by which an image of the given size can be shrunk
+	    as it's decoded without hurting the result of the planned commands,
+	    which is only more than 1 when they start out by scaling it down. """
+	box = (0, 0) + size
+	if planned and planned[0][0] is crop_box:
+		box = planned[0][1]
+		planned = planned[1:]
+
+		# a crop which reaches past the edges pads the image, and the padding
+		# is only the right size when it's cropped from the full image
+		if box[0] < 0 or box[1] < 0 or box[2] > size[0] or box[3] > size[1]:
+			return 1
+
+	if not planned or planned[0][0] is not resample:
+		return 1
+
+	width, height = planned[0][1]
+	ratio = min(float(box[2] - box[0]) / width, float(box[3] - box[1]) / height)
+	return max(int(ratio / REDUCING_GAP), 1)
+
+
+def decode(filename, todo):
+	""" Open the image at filename (a path or a file object) and plan todo
+	    against it.  When the plan starts by scaling the image down, a JPEG is
+	    decoded at a reduced DCT scale, so a big original is never decoded at
+	    full resolution just to be thrown away.
+
+	    Returns the image and the plan, adjusted to the reduced image. """
+	img = Image.open(filename)
+	planned = plan(todo, img.size)
+
+	factor = reduction(planned, img.size)
+	if factor == 1:
+		return img, planned
+
+	size = img.size
+
+	# only JPEGs do anything with this, and only down to 1/8 scale
+	img.draft(img.mode, (size[0] // factor, size[1] // factor))
+
+	if planned[0][0] is crop_box and img.size != size:
+		x_ratio, y_ratio = float(img.size[0]) / size[0], float(img.size[1]) / size[1]
+		left, upper, right, lower = planned[0][1]
+
+		left, upper = int(left * x_ratio), int(upper * y_ratio)
+		right = min(max(int(round(right * x_ratio)), left + 1), img.size[0])
+		lower = min(max(int(round(lower * y_ratio)), upper + 1), img.size[1])
+		planned = [(crop_box, (left, upper, right, lower))] + planned[1:]
+
+	return img, planned
+
+
+def run_pipeline(filename, todo):
+	""" Decode the image at filename once, apply all of the commands to it in
+	    memory and encode it back to filename once.  The commands are planned
+	    against the size of the image before any of them are run. """
+	img, planned = decode(filename, todo)
+	img, format = apply_commands(img, planned)
+	encode_image(img, filename, format)
+
+
+def process_data(data, ext, todo):
+	""" The same as run_pipeline() for an image that's held in memory rather
+	    than on disk.  ext is the extension of the file that data came from
+	    and decides the format it's encoded as.  Returns the encoded image. """
+	original, planned = decode(BytesIO(data), todo)
+	img, format = apply_commands(original, planned)
+
+	if not format:
+		Image.init()
+		format = Image.EXTENSION.get(ext.lower(), 'JPEG')
+
+	out = BytesIO()
+	encode_image(img, out, format)
+	return out.getvalue()
+
+
+def common_prefix(todos):
+	""" The commands which all of the todo lists start with """
+	prefix = []
+	for commands in zip(*todos):
+		if any(command != commands[0] for command in commands):
+			break
+		prefix.append(commands[0])
+	return prefix
+
+
+def run_pipelines(filename, todos, outputs):
+	""" Decode the image at filename once and run each of todos against it,
+	    encoding the results to the corresponding filename in outputs.  The
+	    commands that the todo lists start with in common are only run once.
+	    Where all that's left of each is a width command, as when building a 
+	    srcset, the image is shrunk while decoding to suit the first one and
+	    each is resampled from the one before it, so they should be given
+	    largest first. """
+	prefix = common_prefix(todos)
+	suffixes = [todo[len(prefix):] for todo in todos]
+	widths_only = all(len(suffix) == 1 and suffix[0][0] is width for suffix in suffixes)
+
+	if not prefix and widths_only:
+		base, planned = decode(filename, suffixes[0])
+		format = None
+	else:
+		img, planned = decode(filename, prefix)
+		base, format = apply_commands(img, planned)
+
+	previous = None
+	for suffix, output in zip(suffixes, outputs):
+		if widths_only:
+			source = previous if previous is not None and previous.size[0] >= int(suffix[0][1][0]) else base
+		else:
+			# some commands draw on the image they're given
+			source = base.copy()
+
+		img, suffix_format = apply_commands(source, plan(suffix, source.size))
+		encode_image(img, output, suffix_format or format)
+		previous = img
@@ -0,0 +1,216 @@
+from PIL import Image
+
+from urlimaging.image import *
+from urlimaging.validator import *
+
+
+def thumbnail_dimensions(size, box):
+	""" The size PIL's Image.thumbnail() shrinks an image of the given size to
+	    so that it fits within box.  It never makes an image larger. """
+	x, y = size
+	if x > box[0]:
+		y = max(y * box[0] // x, 1)
+		x = box[0]
+	if y > box[1]:
+		x = max(x * box[1] // y, 1)
+		y = box[1]
+	return x, y
+
+
+def dimensions(width, height):
+	width, height = int(width), int(height)
+	if width < 1 or height < 1:
+		raise ValueError('Resampled image would be empty: width=%d,height=%d' % (width, height))
+	return width, height
+
+
+def zoom_steps(size, width, height):
+	""" The resample and crop that zoom() does, computed the same way """
+	w, h = size
+	source_aspect_ratio = float(w) / float(h)
+	desired_aspect_ratio = float(width) / float(height)
+
+	if source_aspect_ratio > desired_aspect_ratio:
+		temp_width, temp_height = int(height * source_aspect_ratio), height
+	else:
+		temp_width, temp_height = width, int(width / source_aspect_ratio)
+
+	if w < h:
+		to_crop = int((temp_height - height) / 2.0)
+		crop_points = (0, to_crop, width, height + to_crop)
+	else:
+		to_crop = int((temp_width - width) / 2.0)
+		crop_points = (to_crop, 0, width + to_crop, height)
+
+	return [('resample', dimensions(temp_width, temp_height)), ('crop', crop_points)]
+
+
+def square_steps(size, s):
+	""" The resample and crop that square() does, computed the same way """
+	width, height = size
+	half_size = s / 2.0
+
+	if width == height:
+		return [('resample', (s, s))]
+	elif width > height:
+		width = int(width * (float(s) / float(height)))
+		return [('resample', dimensions(width, s)),
+			('crop', (int(width / 2.0 - half_size), 0, int(width / 2.0 + half_size), s))]
+	else:
+		height = int(height * (float(s) / float(width)))
+		return [('resample', dimensions(s, height)),
+			('crop', (0, int(height / 2.0 - half_size), s, int(height / 2.0 + half_size)))]
+
+
+def geometry_steps(fn, args, size):
+	""" Break a geometric command down into resample, crop and rotate steps
+	    given the size of the image it will be applied to.  Returns None for
+	    commands which don't change the geometry of the image and raises a
+	    ValueError for arguments which the command itself would reject. """
+	w, h = size
+
+	if fn is resize:
+		new_width, new_height = int(args[0]), int(args[1])
+		validate_width_height(new_width, new_height)
+		return [('resample', (new_width, new_height))]
+
+	elif fn is scale:
+		percent = int(args[0])
+		validate_percent(percent)
+		p = percent * 0.01
+		return [('resample', dimensions(w * p, h * p))]
+
+	elif fn is width:
+		return [('resample', dimensions(args[0], float(h) * (float(args[0]) / float(w))))]
+
+	elif fn is height:
+		return [('resample', dimensions(float(w) * (float(args[0]) / float(h)), args[0]))]
+
+	elif fn is fit:
+		return [('resample', thumbnail_dimensions(size, dimensions(*args)))]
+
+	elif fn is thumbnail:
+		s = thumbnail_size(args[0])
+		return [('resample', thumbnail_dimensions(size, dimensions(s, s)))]
+
+	elif fn is zoom:
+		return zoom_steps(size, *dimensions(*args))
+
+	elif fn is square:
+		s = int(args[0])
+		validate_width_height(s, s)
+		return square_steps(size, s)
+
+	elif fn is crop:
+		x, y, crop_width, crop_height = [int(arg) for arg in args]
+		validate_x_y(x, y)
+		validate_width_height(crop_width, crop_height)
+		return [('crop', (x, y, x + crop_width, y + crop_height))]
+
+	elif fn is rotate:
+		return [('rotate', int(args[0]))]
+
+	return None
+
+
+class Segment:
+	""" A run of resamples and crops, reduced to a single crop of its input
+	    followed by a single resample. """
+	def __init__(self, size):
+		self.size = size
+		self.box = (0, 0) + size
+		self.out = size
+
+	def resample(self, size):
+		self.out = size
+
+	def crop(self, box):
+		""" Fold a crop (in output coordinates) into the segment by mapping it
+		    back onto the segment's input.  Returns False for crops which reach
+		    outside of the image, since those pad it rather than just cut it. """
+		left, upper, right, lower = box
+		w, h = self.out
+		if left < 0 or upper < 0 or right > w or lower > h \
+				or left >= right or upper >= lower:
+			return False
+
+		l, t, r, b = self.box
+		x_ratio, y_ratio = float(r - l) / w, float(b - t) / h
+
+		new_left = l + int(round(left * x_ratio))
+		new_upper = t + int(round(upper * y_ratio))
+		self.box = (new_left, new_upper,
+				max(l + int(round(right * x_ratio)), new_left + 1),
+				max(t + int(round(lower * y_ratio)), new_upper + 1))
+		self.out = (right - left, lower - upper)
+
+		return True
+
+	def commands(self):
+		todo = []
+		if self.box != (0, 0) + self.size:
+			todo.append((crop_box, self.box))
+		if self.out != (self.box[2] - self.box[0], self.box[3] - self.box[1]):
+			todo.append((resample, self.out))
+		return todo
+
+
+def rotation(degrees, size):
+	""" A lossless transpose equivalent to rotate() (which doesn't expand the
+	    image) by the given number of degrees, None if there isn't one or ()
+	    if the rotation doesn't do anything. """
+	degrees = degrees % 360
+	if degrees == 0:
+		return ()
+	elif degrees == 180:
+		return (transpose, (Image.ROTATE_180,))
+	elif size[0] == size[1] and degrees == 90:
+		return (transpose, (Image.ROTATE_270,))
+	elif size[0] == size[1] and degrees == 270:
+		return (transpose, (Image.ROTATE_90,))
+	return None
+
+
+def plan(todo, size):
+	""" Normalize a CommandRunner's todo list for an image of the given size
+	    before it's run through the pipeline.  Consecutive resamples are
+	    collapsed into one, crops are moved ahead of resamples by mapping them
+	    back onto the source image, rotations by multiples of 90 degrees become
+	    transposes and commands which wouldn't change anything are dropped.
+
+	    Commands which don't change the geometry of an image are left where
+	    they are, and as when running the commands literally, planning stops
+	    at the first command with invalid arguments. """
+	planned = []
+	segment = Segment(size)
+
+	for fn, args in todo:
+		try:
+			steps = geometry_steps(fn, args, segment.out)
+		except (ValueError, ZeroDivisionError):
+			break
+
+		if steps is None:
+			planned.extend(segment.commands())
+			planned.append((fn, args))
+			segment = Segment(segment.out)
+			continue
+
+		for step, value in steps:
+			if step == 'resample':
+				segment.resample(value)
+			elif step == 'crop' and not segment.crop(value):
+				planned.extend(segment.commands())
+				planned.append((crop_box, value))
+				segment = Segment((value[2] - value[0], value[3] - value[1]))
+			elif step == 'rotate':
+				transposed = rotation(value, segment.out)
+				if transposed == ():
+					continue
+
+				planned.extend(segment.commands())
+				planned.append(transposed or (rotate, (value,)))
+				segment = Segment(segment.out)
+
+	planned.extend(segment.commands())
+	return planned
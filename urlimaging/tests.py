@@ -1,10 +1,22 @@
-import sys, datetime, mox
+import sys, os, shutil, tempfile, socket, hashlib, datetime, time, threading, urllib2, httplib, BaseHTTPServer, mox
+from StringIO import StringIO
 from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from urlimaging.models import *
 from urlimaging.validator import *
+from urlimaging.pipeline import *
+from urlimaging.planner import *
+from urlimaging.views import redirect, not_modified, send_file, failure_response
+from urlimaging.backends.default import LocalImageStorage, SCPImageStorage, TieredImageStorage, \
+		shard_path, retry, transient_error
+from urlimaging.lru import DiskLRUCache
+from urlimaging.originals import OriginalCache
+from urlimaging.fetcher import Fetcher, SiteLimiter, FetchLimitExceeded
+from urlimaging.backends.processing import ProcessPoolImageProcessor, ImageProcessingException
 import boto.s3.key
+from PIL import ImageStat
 
 
 GOOD_IMAGE = 'patrickomatic.com/photography/brewing.jpg'
@@ -16,6 +28,7 @@ class CommandRunnerTest(TestCase):
 		self.cr = CommandRunner()
 		self.mox = mox.Mox()
 		self.site = Site.objects.get(domain_name='patrickomatic.com')
+		IMAGE_URLS.local.clear()
 
 	def tearDown(self):
 		self.mox.UnsetStubs()
@@ -166,6 +179,31 @@ class CommandRunnerTest(TestCase):
 				'square/500/resize/1000x1000/bw/sharpen/blur/square/60/square/60/' + GOOD_IMAGE,
 				])
 
+	def test_parse_url__case(self):
+		self.cr.parse_url('RESIZE/50x50/Thumb/Small/' + GOOD_IMAGE)
+		self.assertEquals([(resize, ('50', '50')), (thumbnail, ('Small',))], self.cr.todo)
+		self.assertEquals('resize/50x50/thumb/small/', self.cr.operations)
+
+	def test_parse_url__cached(self):
+		self.cr.parse_url('resize/50x50/' + GOOD_IMAGE)
+		self.cr.todo.append((blur, ()))
+
+		cr = CommandRunner('resize/50x50/' + GOOD_IMAGE)
+		self.assertEquals([(resize, ('50', '50'))], cr.todo)
+		self.assertEquals(self.cr.hash, cr.hash)
+		self.assertEquals('http://' + GOOD_IMAGE, cr.url)
+		self.assertEquals('.jpg', cr.ext)
+
+	def test_parse_commands(self):
+		todo, operations, url, ext, hash, filename = parse_commands('bw/square/300/' + GOOD_IMAGE)
+		self.assertEquals([(black_and_white, ()), (square, ('300',))], todo)
+		self.assertEquals('bw/square/300/', operations)
+		self.assertEquals(hashlib.sha224('bw/square/300/' + GOOD_IMAGE).hexdigest(), hash)
+
+	def test_parse_commands__convert(self):
+		self.assertEquals('.png', parse_commands('convert/png/' + GOOD_IMAGE)[3])
+		self.assertEquals('.jpg', parse_commands('convert/jpeg/patrickomatic.com/a.png')[3])
+
 	def assert_good_urls(self, urls):
 		for url in urls:
 			self.cr = CommandRunner()	
@@ -229,10 +267,8 @@ class CommandRunnerTest(TestCase):
 		image = ModifiedImage.objects.get(hash=hash)
 
 	def __mock_s3(self):
-		self.mox.StubOutWithMock(boto.s3.key, '__init__')
-		boto.s3.key.Key(mox.IgnoreArg())
-		self.mox.StubOutWithMock(boto.s3.key.Key, 'set_contents_from_filename')
-		boto.s3.key.Key.set_contents_from_filename(mox.IgnoreArg(), mox.IgnoreArg())
+		self.mox.StubOutWithMock(settings.IMAGE_STORAGE, 'save_image')
+		settings.IMAGE_STORAGE.save_image(mox.IgnoreArg(), mox.IgnoreArg())
 		self.mox.ReplayAll()
 
 
@@ -284,6 +320,9 @@ class ValidatorTest(TestCase):
 
 
 class ImageViewsTest(TestCase):
+	def setUp(self):
+		FAILURES.local.clear()
+
 	def test_modify(self):
 		response = self.client.get('/bw/' + GOOD_IMAGE)
 		self.assert_(response.status_code == 302)
@@ -326,10 +365,109 @@ class ImageViewsTest(TestCase):
 		response = self.client.get('/square/300/' + GOOD_IMAGE)
 		self.assertRedirects(response, 'http://urlimg.com/media/suspended.png')
 
+	def test_modify__cacheable(self):
+		settings.IMAGE_REDIRECT_MAX_AGE = 60
+		try:
+			response = self.client.get('/square/300/' + GOOD_IMAGE)
+			self.assert_(response.status_code == 302)
+			self.assert_('max-age=60' in response['Cache-Control'])
+		finally:
+			settings.IMAGE_REDIRECT_MAX_AGE = 0
+
+	def test_redirect__stale(self):
+		response = redirect('http://example.com/a.jpg', {'url': 'http://example.com/a.jpg', 
+				'expires': time.time() - 1, 'stable': True})
+		self.assertEquals(302, response.status_code)
+		self.assertFalse(response.has_header('Cache-Control'))
+
+	def test_redirect__permanent(self):
+		settings.IMAGE_REDIRECT_MAX_AGE = 60
+		settings.IMAGE_PERMANENT_REDIRECT = True
+		try:
+			location = {'url': 'http://example.com/a.jpg', 'expires': time.time() + 3600, 'stable': True}
+			self.assertEquals(301, redirect(location['url'], location).status_code)
+
+			location['stable'] = False
+			self.assertEquals(302, redirect(location['url'], location).status_code)
+		finally:
+			settings.IMAGE_REDIRECT_MAX_AGE = 0
+			settings.IMAGE_PERMANENT_REDIRECT = False
+
+	def test_serve(self):
+		settings.IMAGE_DELIVERY = 'serve'
+		try:
+			response = self.client.get('/square/300/' + GOOD_IMAGE)
+			self.assertEquals(200, response.status_code)
+			self.assertEquals('image/jpeg', response['Content-Type'])
+
+			response = self.client.get('/square/300/' + GOOD_IMAGE, HTTP_IF_NONE_MATCH=response['ETag'])
+			self.assertEquals(304, response.status_code)
+		finally:
+			settings.IMAGE_DELIVERY = 'redirect'
+
+	def test_send_file__x_accel_redirect(self):
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(settings.IMAGE_STORAGE, 'get_image_path')
+		settings.IMAGE_STORAGE.get_image_path(mox.IgnoreArg()).AndReturn(__file__)
+		self.mox.ReplayAll()
+
+		settings.IMAGE_DELIVERY = 'x-accel-redirect'
+		root, settings.IMAGE_ACCEL_REDIRECT_ROOT = settings.IMAGE_ACCEL_REDIRECT_ROOT, os.path.dirname(__file__)
+		try:
+			response = send_file(ModifiedImage(hash='xxx', ext='.jpg'), 'image/jpeg')
+			self.assertEquals('/protected-images/' + os.path.basename(__file__), response['X-Accel-Redirect'])
+		finally:
+			settings.IMAGE_DELIVERY = 'redirect'
+			settings.IMAGE_ACCEL_REDIRECT_ROOT = root
+			self.mox.UnsetStubs()
+
+	def test_not_modified(self):
+		location = {'etag': 'abc', 'generated': 1000000000}
+		request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"abc"')
+		self.assert_(not_modified(request, location))
+
+		request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"def"', 
+				HTTP_IF_MODIFIED_SINCE='Sun, 09 Sep 2001 01:46:40 GMT')
+		self.assertFalse(not_modified(request, location))
+
+		request = RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE='Sun, 09 Sep 2001 01:46:40 GMT')
+		self.assert_(not_modified(request, location))
+
+		request = RequestFactory().get('/', HTTP_IF_MODIFIED_SINCE='Sun, 09 Sep 2001 01:46:39 GMT')
+		self.assertFalse(not_modified(request, location))
+
 	def test_modify__image_404(self):
 		response = self.client.get('/square/300/patrickomatic.com/foo.jpg')
 		self.assert_(response.status_code == 404)
 
+	def test_modify__remembers_failure(self):
+		self.client.get('/square/300/patrickomatic.com/foo.jpg')
+		self.assertEquals('not_found', recent_failure('square/300/patrickomatic.com/foo.jpg')[0])
+
+		response = self.client.get('/square/300/patrickomatic.com/foo.jpg')
+		self.assertEquals(404, response.status_code)
+		self.assert_('max-age=' in response['Cache-Control'])
+
+	def test_modify__unparseable(self):
+		response = self.client.get('/nothing/patrickomatic.com/foo.jpg')
+		self.assertEquals(404, response.status_code)
+		self.assertEquals('unparseable', recent_failure('nothing/patrickomatic.com/foo.jpg')[0])
+
+	def test_modify__unparseable_with_media_url(self):
+		media_url, settings.MEDIA_URL = settings.MEDIA_URL, 'http://media.example.com/'
+		try:
+			response = self.client.get('/nothing/patrickomatic.com/foo.jpg')
+		finally:
+			settings.MEDIA_URL = media_url
+
+		self.assertEquals(404, response.status_code)
+		self.assertEquals('unparseable', recent_failure('nothing/patrickomatic.com/foo.jpg')[0])
+
+	def test_failure_response__unavailable(self):
+		response = failure_response('unavailable', time.time() + 30)
+		self.assertEquals(503, response.status_code)
+		self.assert_(int(response['Retry-After']) > 0)
+
 
 class ImageModelsTest(TestCase):
 	def test_domain_name(self):
@@ -356,6 +494,10 @@ class ImageModelsTest(TestCase):
 		self.assert_('1024.00 TB' == readable_bytes(1024 * 1024 * 1024 * 1024 * 1024))
 		self.assert_('3072.00 TB' == readable_bytes(3 * 1024 * 1024 * 1024 * 1024 * 1024))
 
+	def test_latin1_to_ascii(self):
+		self.assertEquals('resize/300x400/', latin1_to_ascii(u'resize/300\xd7400/'))
+		self.assertEquals('Aefoo', latin1_to_ascii(u'\xc6foo\u2603'))
+
 	def test_url_path(self):
 		self.assert_('/foo/poo/foo.jpg' == url_path('http://google.com/foo/poo/foo.jpg'))
 		self.assert_('/foo/poo/Foo.jpg' == url_path('http://www.google.com/foo/poo/Foo.jpg'))
@@ -412,6 +554,647 @@ class ImageModelsTest(TestCase):
 		self.assert_(times_called[0] == 3)
 
 
+class PresetTest(TestCase):
+	def setUp(self):
+		settings.IMAGE_PRESETS = {'card': 'zoom/400x300/sharpen'}
+
+	def tearDown(self):
+		settings.IMAGE_PRESETS = {}
+
+	def test_expand_preset(self):
+		self.assertEquals('zoom/400x300/sharpen/example.com/a.jpg', expand_preset('preset/card/example.com/a.jpg'))
+		self.assertEquals('preset/none/example.com/a.jpg', expand_preset('preset/none/example.com/a.jpg'))
+
+	def test_expand_preset__case_sensitive(self):
+		self.assertEquals('Preset/card/example.com/a.jpg', expand_preset('Preset/card/example.com/a.jpg'))
+		self.assertEquals('preset/Card/example.com/a.jpg', expand_preset('preset/Card/example.com/a.jpg'))
+
+	def test_parse_commands__preset(self):
+		self.assertEquals(parse_commands('zoom/400x300/sharpen/example.com/a.jpg')[1:],
+				parse_commands('preset/card/example.com/a.jpg')[1:])
+
+	def test_prewarm__queued(self):
+		settings.IMAGE_BUILD_MODE = 'queue'
+		try:
+			prewarm('example.com/a.jpg')
+		finally:
+			settings.IMAGE_BUILD_MODE = 'inline'
+
+		self.assertEquals(['preset/card/example.com/a.jpg'], [job.url for job in Job.objects.filter(kind=Job.BUILD)])
+
+	def test_prewarm__inline(self):
+		settings.IMAGE_PRESETS['thumb'] = 'square/50'
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(sys.modules['urlimaging.models'], 'run_in_background')
+		sys.modules['urlimaging.models'].run_in_background(mox.IgnoreArg(), build_derivatives, 
+				mox.SameElementsAs(['preset/card/example.com/a.jpg', 'preset/thumb/example.com/a.jpg']))
+		self.mox.ReplayAll()
+
+		try:
+			prewarm('example.com/a.jpg')
+			self.mox.VerifyAll()
+		finally:
+			self.mox.UnsetStubs()
+
+
+class OriginHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		if self.path == '/redirect':
+			self.send_response(302)
+			self.send_header('Location', '/image.jpg')
+			self.send_header('Content-Length', '0')
+		elif self.headers.getheader('if-modified-since'):
+			self.send_response(304)
+		else:
+			self.send_response(200)
+			self.send_header('Content-Type', 'image/jpeg')
+			self.send_header('Content-Length', '5')
+		self.end_headers()
+
+		if self.path == '/image.jpg' and not self.headers.getheader('if-modified-since'):
+			self.wfile.write('image')
+
+	def log_message(self, *args):
+		pass
+
+
+class FetcherTest(TestCase):
+	def setUp(self):
+		self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), OriginHandler)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+		self.url = 'http://127.0.0.1:%d' % self.server.server_port
+		self.fetcher = Fetcher()
+
+	def tearDown(self):
+		self.fetcher.pool.clear()
+		self.server.shutdown()
+
+	def test_fetch__keep_alive(self):
+		for i in range(2):
+			response = self.fetcher.fetch(self.url + '/image.jpg')
+			self.assertEquals('image', response.read(4096))
+			self.assertEquals('', response.read(4096))
+			response.close()
+
+		self.assertEquals(1, len(self.fetcher.pool.idle.values()[0]))
+
+	def test_fetch__redirect(self):
+		response = self.fetcher.fetch(self.url + '/redirect')
+		self.assertEquals('image', response.read(4096))
+		response.close()
+
+	def test_fetch__not_modified(self):
+		try:
+			self.fetcher.fetch(self.url + '/image.jpg', {'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+			self.fail()
+		except urllib2.HTTPError as e:
+			self.assertEquals(304, e.code)
+
+	def test_site_limiter(self):
+		limiter = SiteLimiter(1)
+		limiter.acquire('example.com', time.time() + 1)
+		self.assertRaises(FetchLimitExceeded, limiter.acquire, 'example.com', time.time() + 0.1)
+
+		limiter.release('example.com')
+		limiter.acquire('example.com', time.time() + 0.1)
+
+
+class SrcsetTest(TestCase):
+	def test_srcset_paths(self):
+		self.assertEquals(['blur/width/640/example.com/a.jpg', 'blur/width/320/example.com/a.jpg'],
+				srcset_paths('blur/example.com/a.jpg', [320, 640, 320]))
+
+	def test_srcset_paths__invalid(self):
+		self.assertEquals([], srcset_paths('not an image', [320]))
+
+	def test_build_derivatives__different_originals(self):
+		self.assertRaises(ValueError, build_derivatives, 
+				['width/10/example.com/a.jpg', 'width/10/example.com/b.jpg'])
+
+
+class LookupCacheTest(TestCase):
+	fixtures = ['image']
+
+	def setUp(self):
+		IMAGE_URLS.local.clear()
+		SITES.local.clear()
+		self.mox = mox.Mox()
+
+	def tearDown(self):
+		self.mox.UnsetStubs()
+
+
+	def test_image_location(self):
+		image = ModifiedImage.objects.get(id=1)
+		image.last_checked = now()
+
+		location = image_location(image)
+		self.assertEquals(location, IMAGE_URLS.get(image.hash))
+		self.assert_(location['expires'] > time.time())
+
+	def test_image_location__needs_check(self):
+		image = ModifiedImage.objects.get(id=1)
+		image_location(image)
+		self.assertEquals(None, IMAGE_URLS.get(image.hash))
+
+	def test_run_commands__cached(self):
+		IMAGE_URLS.set('xxx', {'url': 'http://example.com/xxx.jpg'}, 60)
+
+		cr = CommandRunner('resize/50x50/' + GOOD_IMAGE)
+		cr.hash = 'xxx'
+		self.assertEquals('http://example.com/xxx.jpg', cr.run_commands())
+
+	def test_delete__invalidates(self):
+		self.mox.StubOutWithMock(settings.IMAGE_STORAGE, 'delete_image')
+		settings.IMAGE_STORAGE.delete_image(mox.IgnoreArg())
+		self.mox.ReplayAll()
+
+		image = ModifiedImage.objects.get(id=1)
+		IMAGE_URLS.set(image.hash, {'url': 'http://example.com/xxx.jpg'}, 60)
+		image.delete()
+		self.assertEquals(None, IMAGE_URLS.get(image.hash))
+
+		self.mox.VerifyAll()
+
+	def test_set__local_only(self):
+		# without a shared cache, failures are remembered for as long as they're cached for
+		FAILURES.local.clear()
+		failure, until = remember_failure('example.com/a.jpg', 'not_image')
+		expires, value = FAILURES.local.items[failure_key('example.com/a.jpg')]
+		self.assert_(expires > time.time() + settings.IMAGE_LOOKUP_LOCAL_TIMEOUT)
+
+	def test_get_site(self):
+		site = get_site('patrickomatic.com')
+		self.assertEquals(site, get_site('patrickomatic.com'))
+		self.assertEquals(site, SITES.get('patrickomatic.com'))
+
+	def test_get_site__new(self):
+		site = get_site('example.com')
+		self.assertEquals(site, Site.objects.get(domain_name='example.com'))
+
+
+class StaleWhileRevalidateTest(TestCase):
+	def setUp(self):
+		IMAGE_URLS.local.clear()
+		self.mox = mox.Mox()
+		self.stale, settings.IMAGE_STALE_WHILE_REVALIDATE = settings.IMAGE_STALE_WHILE_REVALIDATE, True
+
+		self.cr = CommandRunner('resize/10x10/example.com/a.jpg')
+		self.image = self.cr.new_image()
+
+	def tearDown(self):
+		self.mox.UnsetStubs()
+		settings.IMAGE_STALE_WHILE_REVALIDATE = self.stale
+
+	def checked_ago(self, seconds):
+		self.image.last_checked = now() - datetime.timedelta(seconds=seconds)
+		self.image.save()
+
+
+	def test_run_commands__stale(self):
+		self.checked_ago(self.image.check_interval() + 60)
+
+		self.mox.StubOutWithMock(sys.modules['urlimaging.models'], 'run_in_background')
+		self.mox.StubOutWithMock(self.cr, 'build')
+		sys.modules['urlimaging.models'].run_in_background(self.cr.hash, self.cr.build, mox.IgnoreArg())
+		self.mox.ReplayAll()
+
+		self.assertEquals(settings.IMAGE_STORAGE.get_image_url(self.image), self.cr.run_commands())
+		self.mox.VerifyAll()
+
+	def test_run_commands__too_stale(self):
+		self.checked_ago(self.image.check_interval() + settings.IMAGE_MAX_STALENESS + 60)
+
+		self.mox.StubOutWithMock(sys.modules['urlimaging.models'], 'run_in_background')
+		self.mox.StubOutWithMock(self.cr, 'build')
+		self.cr.build(mox.IgnoreArg()).AndReturn('http://example.com/xxx.jpg')
+		self.mox.ReplayAll()
+
+		# checked synchronously rather than in the background
+		self.assertEquals('http://example.com/xxx.jpg', self.cr.run_commands())
+		self.mox.VerifyAll()
+
+	def test_can_serve_stale__from_when_due(self):
+		# checked longer ago than IMAGE_MAX_STALENESS, but not that long after it was due
+		self.image.fresh_for = 2 * settings.IMAGE_MAX_STALENESS
+		self.checked_ago(self.image.fresh_for + 60)
+		self.assert_(self.cr.can_serve_stale(self.image))
+
+		self.checked_ago(self.image.fresh_for + settings.IMAGE_MAX_STALENESS + 60)
+		self.assertFalse(self.cr.can_serve_stale(self.image))
+
+	def test_run_in_background__once_per_key(self):
+		started, release, done = threading.Event(), threading.Event(), threading.Event()
+		calls = []
+
+		def task(n):
+			calls.append(n)
+			started.set()
+			release.wait(5)
+
+		run_in_background('key', task, 1)
+		started.wait(5)
+		run_in_background('key', task, 2)
+		release.set()
+
+		# the key is free again once the first call is done
+		for i in range(100):
+			run_in_background('key', lambda: done.set())
+			if done.wait(0.05):
+				break
+
+		self.assertEquals([1], calls)
+		self.assert_(done.is_set())
+
+
+class FreshnessTest(TestCase):
+	def headers(self, text):
+		return httplib.HTTPMessage(StringIO(text))
+
+	def test_max_age(self):
+		self.assertEquals(3600, freshness(self.headers('Cache-Control: public, max-age=3600\r\n\r\n')))
+
+	def test_clamped(self):
+		self.assertEquals(settings.IMAGE_MIN_CHECK_INTERVAL, freshness(self.headers('Cache-Control: max-age=0\r\n\r\n')))
+		self.assertEquals(settings.IMAGE_MAX_CHECK_INTERVAL, freshness(self.headers('Cache-Control: max-age=999999999\r\n\r\n')))
+		self.assertEquals(settings.IMAGE_MIN_CHECK_INTERVAL, freshness(self.headers('Cache-Control: no-cache\r\n\r\n')))
+
+	def test_expires(self):
+		self.assertEquals(7200, freshness(self.headers('Date: Mon, 01 Jan 2001 00:00:00 GMT\r\n'
+				'Expires: Mon, 01 Jan 2001 02:00:00 GMT\r\n\r\n')))
+
+	def test_none(self):
+		self.assertEquals(None, freshness(self.headers('Content-Type: image/jpeg\r\n\r\n')))
+
+
+class PendingExecutor:
+	""" Takes jobs but never runs them """
+	def submit(self, *args):
+		from concurrent.futures import Future
+		return Future()
+
+
+class ProcessPoolImageProcessorTest(TestCase):
+	def setUp(self):
+		self.processor = ProcessPoolImageProcessor()
+		self.processor.get_executor = lambda: PendingExecutor()
+		self.timeout, settings.IMAGE_PROCESS_TIMEOUT = settings.IMAGE_PROCESS_TIMEOUT, 0.01
+		self.previous, settings.IMAGE_PROCESSOR = settings.IMAGE_PROCESSOR, self.processor
+
+		self.cr = CommandRunner('resize/10x10/example.com/a.jpg')
+		self.cr.get_image = lambda image: open(self.cr.filename, 'w').write('image') or True
+
+	def tearDown(self):
+		settings.IMAGE_PROCESS_TIMEOUT = self.timeout
+		settings.IMAGE_PROCESSOR = self.previous
+		if os.path.exists(self.cr.filename):
+			os.unlink(self.cr.filename)
+
+	def test_process__queue_full(self):
+		self.processor.slots = threading.BoundedSemaphore(1)
+		self.processor.slots.acquire()
+
+		open(self.cr.filename, 'w').write('image')
+		self.assertRaises(ImageProcessingException, self.processor.process, self.cr.filename, self.cr.todo)
+
+	def test_process__timeout(self):
+		open(self.cr.filename, 'w').write('image')
+		self.assertRaises(ImageProcessingException, self.processor.process, self.cr.filename, self.cr.todo)
+
+		# the job was cancelled, which gives its slot back
+		for i in range(settings.IMAGE_PROCESS_QUEUE_DEPTH):
+			self.assert_(self.processor.slots.acquire(False))
+
+	def test_build__timeout_removes_work_file(self):
+		self.assertRaises(ImageProcessingException, self.cr.build)
+		self.assertFalse(os.path.exists(self.cr.filename))
+		self.assertFalse(ModifiedImage.objects.filter(hash=self.cr.hash).exists())
+
+	def test_modify__503(self):
+		FAILURES.local.clear()
+		get_image = CommandRunner.get_image
+		CommandRunner.get_image = lambda cr, image: open(cr.filename, 'w').write('image') or True
+		try:
+			response = self.client.get('/resize/10x10/example.com/a.jpg')
+		finally:
+			CommandRunner.get_image = get_image
+
+		self.assertEquals(503, response.status_code)
+		self.assertFalse(os.path.exists(self.cr.filename))
+
+
+class BuildLockTest(TestCase):
+	def test_acquire_build_lock(self):
+		self.assert_(acquire_build_lock('xxx'))
+		self.assertFalse(acquire_build_lock('xxx'))
+		self.assert_(acquire_build_lock('yyy'))
+
+	def test_release_build_lock(self):
+		self.assert_(acquire_build_lock('xxx'))
+		release_build_lock('xxx')
+		self.assert_(acquire_build_lock('xxx'))
+
+	def test_acquire_build_lock__abandoned(self):
+		BuildLock(hash='xxx', acquired=timezone.now() - datetime.timedelta(days=1)).save()
+		self.assert_(acquire_build_lock('xxx'))
+
+
+class JobTest(TestCase):
+	fixtures = ['image']
+
+	def test_enqueue_job(self):
+		enqueue_job(Job.BUILD, 'xxx', 'resize/50x50/' + GOOD_IMAGE)
+		enqueue_job(Job.BUILD, 'xxx', 'resize/50x50/' + GOOD_IMAGE)
+		self.assertEquals(1, Job.objects.filter(hash='xxx').count())
+
+	def test_claim_job(self):
+		enqueue_job(Job.BUILD, 'xxx', 'resize/50x50/' + GOOD_IMAGE)
+
+		job = claim_job()
+		self.assertEquals('xxx', job.hash)
+		self.assertEquals(Job.RUNNING, job.status)
+		self.assertEquals(1, job.attempts)
+		self.assertEquals(None, claim_job())
+
+	def test_claim_job__abandoned(self):
+		Job(kind=Job.BUILD, hash='xxx', url='resize/50x50/' + GOOD_IMAGE, status=Job.RUNNING,
+				created=timezone.now(), started=timezone.now() - datetime.timedelta(days=1)).save()
+		self.assertEquals('xxx', claim_job().hash)
+
+	def test_claim_job__abandoned_too_often(self):
+		Job(kind=Job.BUILD, hash='xxx', url='resize/50x50/' + GOOD_IMAGE, status=Job.RUNNING,
+				created=timezone.now(), started=timezone.now() - datetime.timedelta(days=1),
+				attempts=settings.IMAGE_JOB_ATTEMPTS).save()
+
+		self.assertEquals(None, claim_job())
+		job = Job.objects.get(hash='xxx')
+		self.assertEquals(Job.FAILED, job.status)
+		self.assertEquals('The worker running it died', job.error)
+
+	def test_run_job__failed(self):
+		enqueue_job(Job.BUILD, 'xxx', 'not a url')
+
+		job = claim_job()
+		self.assertFalse(run_job(job))
+		self.assertEquals(Job.PENDING, Job.objects.get(id=job.id).status)
+
+	def test_run_job__delete(self):
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(settings.IMAGE_STORAGE, 'delete_image')
+		settings.IMAGE_STORAGE.delete_image(mox.IgnoreArg())
+		self.mox.ReplayAll()
+
+		image = ModifiedImage.objects.get(id=1)
+		enqueue_job(Job.DELETE, image.hash, image.get_absolute_url()[1:])
+
+		self.assert_(run_job(claim_job()))
+		self.assertFalse(Job.objects.exists())
+		self.assertRaises(ModifiedImage.DoesNotExist, ModifiedImage.objects.get, id=1)
+
+		self.mox.VerifyAll()
+		self.mox.UnsetStubs()
+
+
+class S3ImageStorageTest(TestCase):
+	fixtures = ['image']
+
+	def setUp(self):
+		self.image = ModifiedImage.objects.get(id=1)
+		self.storage = S3ImageStorage()
+
+	def tearDown(self):
+		settings.S3_PUBLIC_BUCKET = False
+
+
+	def test_get_image_url__reused(self):
+		url = self.storage.get_image_url(self.image)
+		self.assertEquals(url, self.storage.get_image_url(self.image))
+
+	def test_get_image_url__public(self):
+		settings.S3_PUBLIC_BUCKET = True
+		self.assert_('Signature' not in self.storage.get_image_url(self.image))
+
+	def test_save_image__unchanged(self):
+		data = StringIO('image')
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(self.storage, 'stored_hash')
+		self.mox.StubOutWithMock(self.storage, 'upload')
+		self.storage.stored_hash(self.image.hashed_filename()).AndReturn(hashlib.sha224('image').hexdigest())
+		self.mox.ReplayAll()
+
+		self.storage.save_image(self.image, data)
+
+		self.mox.VerifyAll()
+		self.mox.UnsetStubs()
+
+	def test_save_image__buffer(self):
+		data = StringIO('image')
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(self.storage, 'stored_hash')
+		self.mox.StubOutWithMock(self.storage, 'upload')
+		self.storage.stored_hash(self.image.hashed_filename()).AndReturn(None)
+		self.storage.upload(self.image.hashed_filename(), data, mox.IgnoreArg(),
+				{'sha224': hashlib.sha224('image').hexdigest()})
+		self.mox.ReplayAll()
+
+		self.storage.save_image(self.image, data)
+
+		self.mox.VerifyAll()
+		self.mox.UnsetStubs()
+
+	def test_delete_images(self):
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(self.storage, 'delete_keys')
+		self.storage.delete_keys([self.image.hashed_filename()])
+		self.mox.ReplayAll()
+
+		self.storage.delete_images([self.image])
+
+		self.mox.VerifyAll()
+		self.mox.UnsetStubs()
+
+	def test_retry__transient(self):
+		calls = []
+
+		@retry(3, Exception, transient=transient_error)
+		def fn():
+			calls.append(1)
+			raise socket.error()
+
+		self.assertRaises(socket.error, fn)
+		self.assertEquals(3, len(calls))
+
+	def test_retry__not_transient(self):
+		calls = []
+
+		@retry(3, Exception, transient=transient_error)
+		def fn():
+			calls.append(1)
+			raise ValueError()
+
+		self.assertRaises(ValueError, fn)
+		self.assertEquals(1, len(calls))
+
+
+class SCPImageStorageTest(TestCase):
+	def setUp(self):
+		settings.SSH_MEDIA_USER, settings.SSH_MEDIA_PATH = 'user@example.com', '/var/images'
+		self.storage = SCPImageStorage()
+		self.image = ModifiedImage(hash='abcdef', ext='.jpg')
+		self.mox = mox.Mox()
+		self.mox.StubOutWithMock(self.storage, '_run')
+
+	def tearDown(self):
+		self.mox.UnsetStubs()
+
+	def test_save_image(self):
+		self.storage._run(mox.And(mox.In('scp'), mox.In('ControlMaster=auto'), 
+				mox.In('user@example.com:/var/images/abcdef.jpg'))).AndReturn(0)
+		self.mox.ReplayAll()
+
+		self.storage.save_image(self.image, '/tmp/abcdef.jpg')
+		self.mox.VerifyAll()
+
+	def test_save_image__failed(self):
+		self.storage._run(mox.IgnoreArg()).AndReturn(1)
+		self.mox.ReplayAll()
+
+		self.assertRaises(Exception, self.storage.save_image, self.image, '/tmp/abcdef.jpg')
+
+	def test_delete_images__batched(self):
+		batch_size, settings.SSH_DELETE_BATCH_SIZE = settings.SSH_DELETE_BATCH_SIZE, 2
+		self.storage._run(mox.In('rm -f -- /var/images/abcdef.jpg /var/images/123456.jpg'), None).AndReturn(0)
+		self.mox.ReplayAll()
+
+		try:
+			self.storage.delete_images([self.image])
+			self.storage.delete_images([ModifiedImage(hash='123456', ext='.jpg')])
+			self.mox.VerifyAll()
+		finally:
+			settings.SSH_DELETE_BATCH_SIZE = batch_size
+
+	def test_delete_image__immediate(self):
+		self.storage._run(mox.In('rm -f -- /var/images/abcdef.jpg'), None).AndReturn(0)
+		self.mox.ReplayAll()
+
+		self.storage.delete_image(self.image)
+		self.mox.VerifyAll()
+
+	def test_delete_images__then_save(self):
+		self.storage._run(mox.In('scp')).AndReturn(0)
+		self.mox.ReplayAll()
+
+		self.storage.delete_images([self.image])
+		self.storage.save_image(self.image, '/tmp/abcdef.jpg')
+
+		# the queued delete would remove the image that was just saved
+		self.storage.flush_deletes()
+		self.mox.VerifyAll()
+
+
+class LocalImageStorageTest(TestCase):
+	def setUp(self):
+		self.storage = LocalImageStorage()
+		self.dir = tempfile.mkdtemp()
+		self.depth = settings.IMAGE_STORAGE_SHARD_DEPTH
+		settings.IMAGE_STORAGE_DIR, settings.IMAGE_STORAGE_SHARD_DEPTH = self.dir, 2
+		self.image = ModifiedImage(hash='abcdef' + 'a' * 50, ext='.jpg')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+		del settings.IMAGE_STORAGE_DIR
+		settings.IMAGE_STORAGE_SHARD_DEPTH = self.depth
+
+	def test_shard_path(self):
+		self.assertEquals('ab/cd/abcdef.jpg', shard_path('abcdef.jpg', 2))
+		self.assertEquals('abcdef.jpg', shard_path('abcdef.jpg', 0))
+
+	def test_save_image(self):
+		work = os.path.join(self.dir, 'work.jpg')
+		open(work, 'w').write('image')
+
+		self.storage.save_image(self.image, work)
+
+		path = self.storage.get_image_path(self.image)
+		self.assertEquals(os.path.join(self.dir, 'ab', 'cd', self.image.hashed_filename()), path)
+		self.assertEquals('image', open(path).read())
+		self.assertEquals(['ab', 'work.jpg'], sorted(os.listdir(self.dir)))
+		self.assertEquals([self.image.hashed_filename()], os.listdir(os.path.dirname(path)))
+
+
+class DiskLRUCacheTest(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.cache = DiskLRUCache(self.dir, 10)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_put_get(self):
+		path = self.cache.put('a.jpg', StringIO('12345'))
+		self.assertEquals(path, self.cache.get('a.jpg'))
+		self.assertEquals('12345', open(path).read())
+		self.assertEquals(None, self.cache.get('b.jpg'))
+
+	def test_evict(self):
+		self.cache.put('a.jpg', StringIO('12345'))
+		self.cache.put('b.jpg', StringIO('12345'))
+		self.cache.get('a.jpg')
+		self.cache.put('c.jpg', StringIO('12345'))
+
+		self.assertEquals(['a.jpg', 'c.jpg'], sorted(os.listdir(self.dir)))
+
+	def test_load(self):
+		self.cache.put('a.jpg', StringIO('12345'))
+		self.assertEquals(5, DiskLRUCache(self.dir, 10).bytes)
+
+
+class TieredImageStorageTest(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.remote, settings.IMAGE_STORAGE_REMOTE_BACKEND = settings.IMAGE_STORAGE_REMOTE_BACKEND, 'LocalImageStorage'
+		self.bytes, settings.IMAGE_LOCAL_CACHE_BYTES = settings.IMAGE_LOCAL_CACHE_BYTES, 1024
+		settings.IMAGE_LOCAL_CACHE_DIR = self.dir
+
+		self.storage = TieredImageStorage()
+		self.storage.remote = mox.MockAnything()
+		self.image = ModifiedImage(hash='abcdef', ext='.jpg')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+		del settings.IMAGE_LOCAL_CACHE_DIR
+		settings.IMAGE_STORAGE_REMOTE_BACKEND = self.remote
+		settings.IMAGE_LOCAL_CACHE_BYTES = self.bytes
+
+	def test_init__no_local_cache_dir(self):
+		del settings.IMAGE_LOCAL_CACHE_DIR
+		try:
+			self.assertRaises(ImproperlyConfigured, TieredImageStorage)
+		finally:
+			settings.IMAGE_LOCAL_CACHE_DIR = self.dir
+
+	def test_save_image(self):
+		data = StringIO('image')
+		self.storage.remote.save_image(self.image, data)
+		mox.Replay(self.storage.remote)
+
+		self.storage.save_image(self.image, data)
+		self.assertEquals('image', self.storage.open_image(self.image).read())
+
+	def test_open_image__promoted(self):
+		self.storage.remote.open_image(self.image).AndReturn(StringIO('image'))
+		mox.Replay(self.storage.remote)
+
+		self.assertEquals('image', self.storage.open_image(self.image).read())
+		self.assertEquals(os.path.join(self.dir, 'abcdef.jpg'), self.storage.get_image_path(self.image))
+		mox.Verify(self.storage.remote)
+
+
 class ModifiedImageTest(TestCase):
 	fixtures = ['image']
 
@@ -484,3 +1267,225 @@ class ImageModuleTest(TestCase):
 		self.assert_(hex_to_rgb('0CF') == (0, 204, 255))
 		self.assert_(hex_to_rgb('#0CF') == (0, 204, 255))
 		self.assert_(hex_to_rgb('#fooooooo') == None)
+
+
+class OriginalCacheTest(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.cache = OriginalCache(self.dir, 1024)
+
+		self.original = os.path.join(self.dir, 'original.jpg')
+		open(self.original, 'w').write('image')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def test_put_get(self):
+		self.assertEquals(None, self.cache.get('http://example.com/a.jpg'))
+		self.cache.put('http://example.com/a.jpg', self.original, 'xxx', 
+				{'last_modified': 'Mon, 01 Jan 2001 00:00:00 GMT', 'etag': '"abc"'})
+
+		cached = self.cache.get('http://example.com/a.jpg')
+		self.assertEquals('xxx', cached['hash'])
+		self.assertEquals('Mon, 01 Jan 2001 00:00:00 GMT', cached['last_modified'])
+		self.assertEquals('"abc"', cached['etag'])
+		self.assertEquals('image', open(cached['path']).read())
+
+	def test_put__evicts_meta(self):
+		cache = OriginalCache(self.dir, 5)
+		cache.put('http://example.com/a.jpg', self.original, 'xxx', {})
+		cache.put('http://example.com/b.jpg', self.original, 'yyy', {})
+
+		self.assertEquals(None, cache.get('http://example.com/a.jpg'))
+		self.assertEquals([cache.key('http://example.com/b.jpg') + '.json'], os.listdir(cache.meta_dir))
+
+	def test_get__missing_file(self):
+		self.cache.put('http://example.com/a.jpg', self.original, 'xxx', {})
+		os.unlink(self.cache.get('http://example.com/a.jpg')['path'])
+
+		self.assertEquals(None, self.cache.get('http://example.com/a.jpg'))
+		self.assertEquals([], os.listdir(self.cache.meta_dir))
+
+	def test_use_original(self):
+		self.cache.put('http://example.com/a.jpg', self.original, 'xxx', {'last_modified': None, 'fresh_for': 600})
+		cr = CommandRunner('resize/10x10/example.com/a.jpg')
+		image = cr.new_image()
+
+		self.assert_(cr.use_original(image, self.cache.get('http://example.com/a.jpg')))
+		self.assertEquals('xxx', image.original_file_hash)
+		self.assertEquals(600, image.check_interval())
+		self.assertEquals('image', open(cr.filename).read())
+		os.unlink(cr.filename)
+
+		self.assertFalse(cr.use_original(image, self.cache.get('http://example.com/a.jpg')))
+
+
+class LRUCacheTest(TestCase):
+	def test_lru_cache(self):
+		cache = LRUCache(2)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		self.assertEquals(1, cache.get('a'))
+
+		cache.set('c', 3)
+		self.assertEquals(None, cache.get('b'))
+		self.assertEquals(1, cache.get('a'))
+		self.assertEquals(3, cache.get('c'))
+
+	def test_lru_cache__delete(self):
+		cache = LRUCache(2)
+		cache.set('a', 1)
+		cache.delete('a')
+		self.assertEquals('x', cache.get('a', 'x'))
+
+
+class PipelineTest(TestCase):
+	def setUp(self):
+		self.filename = '/tmp/urlimaging-pipeline-test.png'
+		Image.new('RGB', (200, 100), (255, 0, 0)).save(self.filename)
+
+	def tearDown(self):
+		os.unlink(self.filename)
+
+
+	def test_run_pipeline(self):
+		run_pipeline(self.filename, [(resize, ('50', '20')), (black_and_white, ())])
+
+		img = Image.open(self.filename)
+		self.assertEquals((50, 20), img.size)
+
+	def test_run_pipeline__stops_on_value_error(self):
+		run_pipeline(self.filename, [(resize, ('50', '20')), (resize, ('0', '0')), (rotate, ('90',))])
+		self.assertEquals((50, 20), Image.open(self.filename).size)
+
+	def test_reduction(self):
+		self.assertEquals(31, reduction([(resample, (96, 64))], (6000, 4000)))
+		self.assertEquals(1, reduction([(resample, (150, 75))], (200, 100)))
+		self.assertEquals(1, reduction([(blur, ()), (resample, (10, 10))], (6000, 4000)))
+
+	def test_reduction__crop(self):
+		self.assertEquals(5, reduction([(crop_box, (0, 0, 1000, 1000)), (resample, (100, 100))], (6000, 4000)))
+
+	def jpeg(self, size):
+		""" A JPEG with vertical stripes, so that stretching it shows """
+		img = Image.new('RGB', size)
+		draw = ImageDraw.Draw(img)
+		for x in range(0, size[0], 8):
+			draw.rectangle((x, 0, x + 3, size[1]), fill=(255, 255 * (x // 8 % 2), 0))
+
+		filename = '/tmp/urlimaging-pipeline-test.jpg'
+		img.save(filename, 'JPEG', quality=95)
+		return filename
+
+	def assertSameImage(self, a, b):
+		self.assertEquals(a.size, b.size)
+		self.assert_(max(ImageStat.Stat(ImageChops.difference(a, b)).mean) < 10)
+
+	def test_reduction__crop_outside(self):
+		self.assertEquals(1, reduction([(crop_box, (79, 80, 286, 114)), (resample, (50, 8))], (242, 741)))
+
+	def test_decode__reduces(self):
+		filename = self.jpeg((2000, 1000))
+		try:
+			img, planned = decode(filename, [(thumbnail, ('small',))])
+			self.assert_(img.size[0] < 2000)
+			self.assertEquals([(resample, (64, 32))], planned)
+		finally:
+			os.unlink(filename)
+
+	def test_decode__crop_padding(self):
+		filename = self.jpeg((242, 741))
+		todo = [(crop, ('79', '80', '207', '34')), (thumbnail, ('50',))]
+		try:
+			img, planned = decode(filename, todo)
+			img, format = apply_commands(img, planned)
+
+			# the same as running the commands one at a time
+			expected = Image.open(filename)
+			for fn, args in todo:
+				expected = fn.transform(expected, *args)
+			self.assertSameImage(expected, img)
+		finally:
+			os.unlink(filename)
+
+	def test_run_pipelines(self):
+		outputs = ['/tmp/urlimaging-pipeline-test-%d.png' % i for i in range(3)]
+		run_pipelines(self.filename, [[(width, ('100',))], [(width, ('50',))], [(width, ('20',))]], outputs)
+
+		try:
+			self.assertEquals([(100, 50), (50, 25), (20, 10)], [Image.open(f).size for f in outputs])
+		finally:
+			for f in outputs:
+				os.unlink(f)
+
+	def test_common_prefix(self):
+		self.assertEquals([(blur, ())], common_prefix([[(blur, ()), (width, ('10',))], [(blur, ()), (width, ('20',))]]))
+		self.assertEquals([], common_prefix([[(blur, ())], [(sharpen, ())]]))
+
+	def test_image_header(self):
+		data = open(self.filename, 'rb').read()
+		self.assertEquals(('PNG', (200, 100)), image_header(data[:1024]))
+		self.assertEquals(None, image_header(data[:4]))
+		self.assertEquals(None, image_header('not an image'))
+
+	def test_check_header(self):
+		data = open(self.filename, 'rb').read()
+		cr = CommandRunner()
+		self.assertEquals(None, cr.check_header(data))
+
+		pixels, settings.IMAGE_MAX_PIXELS = settings.IMAGE_MAX_PIXELS, 100
+		try:
+			self.assertRaises(ImageTooLargeException, cr.check_header, data)
+		finally:
+			settings.IMAGE_MAX_PIXELS = pixels
+
+	def test_process_data(self):
+		data = process_data(open(self.filename, 'rb').read(), '.png', [(resize, ('50', '20'))])
+
+		img = Image.open(StringIO(data))
+		self.assertEquals((50, 20), img.size)
+		self.assertEquals('PNG', img.format)
+
+	def test_apply_commands__convert(self):
+		img, format = apply_commands(Image.open(self.filename), [(convert, ('jpg',))])
+		self.assertEquals('JPEG', format)
+		self.assertEquals('RGB', img.mode)
+
+	def test_apply_commands__background_bad_color(self):
+		img, format = apply_commands(Image.open(self.filename), [(background, ('notacolor',))])
+		self.assertEquals((200, 100), img.size)
+
+
+class PlannerTest(TestCase):
+	def test_plan__collapses_resizes(self):
+		self.assertEquals([(resample, (50, 50))],
+				plan([(resize, ('100', '100')), (resize, ('50', '50'))], (200, 200)))
+
+	def test_plan__crop_before_resize(self):
+		self.assertEquals([(crop_box, (0, 0, 50, 50)), (resample, (200, 200))],
+				plan([(resize, ('4000', '4000')), (crop, ('0', '0', '200', '200'))], (1000, 1000)))
+
+	def test_plan__crop_outside_image(self):
+		self.assertEquals([(resample, (100, 100)), (crop_box, (50, 50, 250, 250))],
+				plan([(resize, ('100', '100')), (crop, ('50', '50', '200', '200'))], (1000, 1000)))
+
+	def test_plan__rotate(self):
+		self.assertEquals([(transpose, (Image.ROTATE_180,))], plan([(rotate, ('180',))], (300, 200)))
+		self.assertEquals([(transpose, (Image.ROTATE_270,))], plan([(rotate, ('90',))], (200, 200)))
+		self.assertEquals([(rotate, (90,))], plan([(rotate, ('90',))], (300, 200)))
+
+	def test_plan__no_ops(self):
+		self.assertEquals([], plan([(rotate, ('360',)), (scale, ('100',)),
+				(fit, ('500', '500')), (crop, ('0', '0', '300', '200'))], (300, 200)))
+
+	def test_plan__filters_stay_in_place(self):
+		self.assertEquals([(resample, (100, 100)), (blur, ()), (resample, (50, 50))],
+				plan([(resize, ('100', '100')), (blur, ()), (resize, ('50', '50'))], (200, 200)))
+
+	def test_plan__stops_on_invalid(self):
+		self.assertEquals([(resample, (50, 50))],
+				plan([(resize, ('50', '50')), (resize, ('0', '0')), (blur, ())], (200, 200)))
+
+	def test_thumbnail_dimensions(self):
+		self.assertEquals((96, 64), thumbnail_dimensions((600, 400), (96, 96)))
+		self.assertEquals((60, 40), thumbnail_dimensions((60, 40), (96, 96)))
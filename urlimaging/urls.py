@@ -4,8 +4,9 @@ except ImportError:
     # newer versions of django have switched to this location
     from django.conf.urls import patterns, url
 
-from urlimaging.views import modify
+from urlimaging.views import modify, srcset
 
 urlpatterns = patterns('',
+		url(r'^srcset/(\d+(?:,\d+)*)/(.*)$', srcset),
 		url(r'^(.*)$', modify),
 )
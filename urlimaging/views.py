@@ -1,31 +1,206 @@
-import sys, unicodedata
-from django.http import Http404, HttpResponseRedirect
+import sys, os, time, mimetypes, unicodedata
+from wsgiref.util import FileWrapper
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, \
+		HttpResponseNotModified, HttpResponseNotFound
 from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
+
+try:
+	from django.http import StreamingHttpResponse
+except ImportError:
+	# older versions of django stream a regular HttpResponse
+	StreamingHttpResponse = HttpResponse
 
 from urlimaging.models import *
+from urlimaging.backends.processing import ImageProcessingException
 
 
 def modify(request, url):
 	if request.META['QUERY_STRING']:
 		url = url + "?" + request.META['QUERY_STRING']
 
+	# don't do anything for urls which have just failed
+	failure = recent_failure(url)
+	if failure:
+		return failure_response(*failure)
+
 	cr = CommandRunner(url)
 
+	# an unparseable url has no original to check against the whitelist
+	if not cr.todo: 
+		print >>sys.stderr, "Unable to parse url: %s" % url
+		return failure_response(*remember_failure(url, 'unparseable'))
+
 	if not settings.IMAGE_WHITELIST_FN(cr.url):
 		raise Http404	
 
 	try:
-		if not cr.todo: 
-			print >>sys.stderr, "Unable to parse url: %s" % url
-			raise Http404
-		
 		img = cr.run_commands()
 		if not img: 
 			print >>sys.stderr, "Unable to run commands: %s" % url
 			raise Http404
 
-		return HttpResponseRedirect(img)
-	except ImageNotFoundException:
-		raise Http404
+		if settings.IMAGE_DELIVERY in ('serve', 'x-accel-redirect', 'x-sendfile'):
+			return serve(request, cr, img, cr.location)
+
+		return redirect(img, cr.location)
+	except ImagePendingException:
+		# it's been queued but isn't done yet, so send them somewhere else for now
+		if settings.IMAGE_QUEUE_FALLBACK == 'original':
+			return HttpResponseRedirect(cr.url)
+		return HttpResponseRedirect(settings.IMAGE_QUEUE_FALLBACK)
+	except (ImageNotFoundException, ImageUnavailableException) as e:
+		return failure_response(*remember_failure(url, e.failure))
+	except ImageProcessingException as e:
+		print >>sys.stderr, "Unable to process image: %s (%s)" % (url, e)
+		return HttpResponse(status=503)
 	
 	raise Http404
+
+
+def failure_response(failure, until):
+	""" A 404, or a 503 if the original is unavailable, which can be cached
+	    for as long as the failure is remembered """
+	seconds = int(until - time.time())
+
+	if failure == 'unavailable':
+		response = HttpResponse(status=503)
+		if seconds > 0:
+			response['Retry-After'] = str(seconds)
+	else:
+		response = HttpResponseNotFound()
+
+	if seconds > 0:
+		patch_cache_control(response, public=True, max_age=seconds)
+
+	return response
+
+
+# the most widths a srcset can be built for at once
+MAX_SRCSET_WIDTHS = 10
+
+
+def srcset(request, widths, url):
+	""" Build the image at url scaled to each of a comma separated list of 
+	    widths all at once, downloading and decoding the original only once,
+	    and respond with a srcset of the urls they can be requested at """
+	path = 'srcset/%s/%s' % (widths, url)
+	if request.META['QUERY_STRING']:
+		url = url + "?" + request.META['QUERY_STRING']
+
+	widths = sorted(set(int(w) for w in widths.split(',') if int(w) > 0), reverse=True)[:MAX_SRCSET_WIDTHS]
+	paths = srcset_paths(url, widths)
+	if not paths or not settings.IMAGE_WHITELIST_FN(CommandRunner(paths[0]).url):
+		raise Http404
+
+	try:
+		build_derivatives(paths)
+	except ImageNotFoundException:
+		raise Http404
+	except ImageUnavailableException:
+		return HttpResponse(status=503)
+	except ImageProcessingException as e:
+		print >>sys.stderr, "Unable to process image: %s (%s)" % (url, e)
+		return HttpResponse(status=503)
+
+	# the images are requested from wherever this app is mounted
+	base = request.path[:-len(path)] if request.path.endswith(path) else '/'
+	return HttpResponse(', '.join('%s%s %dw' % (base, p, w) for p, w in zip(paths, widths)), 
+			content_type='text/plain')
+
+
+def max_age(location):
+	""" How long a response for an image can be cached, in seconds """
+	if not location or not settings.IMAGE_REDIRECT_MAX_AGE:
+		return 0
+	return int(min(settings.IMAGE_REDIRECT_MAX_AGE, location['expires'] - time.time()))
+
+
+def redirect(url, location):
+	""" Redirect to an image in storage.  If IMAGE_REDIRECT_MAX_AGE is set, the
+	    redirect can be cached until the image is due to be checked (or its url
+	    stops working) and, if IMAGE_PERMANENT_REDIRECT is set and the url is
+	    stable, it's permanent.  Nothing about the redirect depends on the
+	    request's headers, so it doesn't Vary on any of them. """
+	seconds = max_age(location)
+	if seconds <= 0:
+		return HttpResponseRedirect(url)
+
+	if settings.IMAGE_PERMANENT_REDIRECT and location['stable']:
+		response = HttpResponsePermanentRedirect(url)
+	else:
+		response = HttpResponseRedirect(url)
+
+	patch_cache_control(response, public=True, max_age=seconds)
+	return response
+
+
+def not_modified(request, location):
+	""" Whether the client's copy of the image is still current """
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match:
+		etags = parse_etags(if_none_match)
+		return '*' in etags or location['etag'] in etags
+
+	if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+	return bool(if_modified_since and location['generated'] \
+			and int(location['generated']) <= if_modified_since)
+
+
+def send_file(image, content_type):
+	""" Have the web server in front of us send the image from the local
+	    filesystem, or None if it isn't there """
+	path = settings.IMAGE_STORAGE.get_image_path(image)
+	if not path or not os.path.exists(path):
+		return None
+
+	response = HttpResponse(content_type=content_type)
+	if settings.IMAGE_DELIVERY == 'x-accel-redirect':
+		# nginx wants the uri of an internal location which maps onto the file
+		response['X-Accel-Redirect'] = settings.IMAGE_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + \
+				os.path.relpath(path, settings.IMAGE_ACCEL_REDIRECT_ROOT).replace(os.sep, '/')
+	else:
+		response['X-Sendfile'] = path
+
+	return response
+
+
+def serve(request, cr, url, location):
+	""" Respond with the image itself rather than redirecting to it, either by
+	    streaming it or with IMAGE_DELIVERY set to 'x-accel-redirect' or
+	    'x-sendfile', by handing the file off to the web server.  Requests for
+	    an image the client already has are answered without going to storage.
+	    If the storage can't provide the image, it's redirected to. """
+	if not location or 'etag' not in location:
+		return redirect(url, location)
+
+	if not_modified(request, location):
+		response = HttpResponseNotModified()
+	else:
+		image = ModifiedImage(hash=cr.hash, ext=cr.ext)
+		content_type = mimetypes.guess_type('image' + cr.ext)[0] or 'application/octet-stream'
+
+		if settings.IMAGE_DELIVERY == 'serve':
+			f = settings.IMAGE_STORAGE.open_image(image)
+			response = StreamingHttpResponse(FileWrapper(f), content_type=content_type) if f else None
+			if response and location['size']:
+				response['Content-Length'] = str(location['size'])
+		else:
+			response = send_file(image, content_type)
+
+		if not response:
+			return redirect(url, location)
+
+		if location['generated']:
+			response['Last-Modified'] = http_date(location['generated'])
+
+	response['ETag'] = quote_etag(location['etag'])
+
+	seconds = max_age(location)
+	if seconds > 0:
+		patch_cache_control(response, public=True, max_age=seconds)
+	else:
+		patch_cache_control(response, no_cache=True)
+
+	return response